@@ -5,8 +5,19 @@ import sys
 import wsgiref.handlers
 
 import webapp2
+import cache
 import handlers
 
-application = webapp2.WSGIApplication(
+
+class WikiApplication(webapp2.WSGIApplication):
+    def __call__(self, environ, start_response):
+        """Drops the request-local cache once the request is handled."""
+        try:
+            return super(WikiApplication, self).__call__(environ, start_response)
+        finally:
+            cache.clear()
+
+
+application = WikiApplication(
     handlers.handlers,
     debug=True)
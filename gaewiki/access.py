@@ -7,20 +7,68 @@ import settings
 import util
 
 
+class Policy(object):
+    """Access settings, compiled once per settings version: patterns are
+    compiled, reader lists turned into sets."""
+    def __init__(self, options):
+        self.options = options
+        self.whitelist = self.compile(options.get('page-whitelist'))
+        self.blacklist = self.compile(options.get('page-blacklist'))
+        self.open_reading = options.get('open-reading', 'yes')
+        self.open_editing = options.get('open-editing')
+        self.parents_must_exist = options.get('parents-must-exist') == 'yes'
+        self.readers = frozenset(util.as_list(options.get('readers')) + util.as_list(options.get('editors')))
+
+    @staticmethod
+    def compile(pattern):
+        if pattern is None:
+            return None
+        return re.compile(pattern)
+
+    def is_whitelisted(self, title):
+        return self.whitelist is not None and self.whitelist.match(title) is not None
+
+    def is_blacklisted(self, title):
+        if self.is_whitelisted(title):
+            return False
+        return self.blacklist is not None and self.blacklist.match(title) is not None
+
+    def is_reader(self, user):
+        """Returns True if the user can read all pages."""
+        return user is not None and user.email() in self.readers
+
+    def can_read(self, page, user):
+        """Checks the access properties stored with the page."""
+        private, public, readers = page.get_acl()
+        if self.open_reading == 'yes':
+            if not private:
+                return True
+            return user is not None and user.email() in readers
+        elif self.open_reading == 'login':
+            return public or user is not None
+        return public
+
+
+# The policy for the current settings.
+policy = None
+
+
+def get_policy():
+    """Returns the policy for the current settings, compiles it again when
+    they change."""
+    global policy
+    options = settings.get_all()
+    if policy is None or policy.options is not options:
+        policy = Policy(options)
+    return policy
+
+
 def is_page_whitelisted(title):
-    pattern = settings.get('page-whitelist')
-    if pattern is None:
-        return False
-    return re.match(pattern, title) is not None
+    return get_policy().is_whitelisted(title)
 
 
 def is_page_blacklisted(title):
-    if is_page_whitelisted(title):
-        return False
-    pattern = settings.get('page-blacklist')
-    if pattern is None:
-        return False
-    return re.match(pattern, title) is not None
+    return get_policy().is_blacklisted(title)
 
 
 def can_edit_page(title, user=None, is_admin=False):
@@ -32,18 +80,20 @@ def can_edit_page(title, user=None, is_admin=False):
     if title.startswith('gaewiki:'):
         return False
 
+    policy = get_policy()
+
     # Don't allow editing of deep trees w/o parent if set that way.
-    if '/' in title and settings.get('parents-must-exist') == 'yes':
+    if '/' in title and policy.parents_must_exist:
         parent_title = '/'.join(title.split('/')[:-1])
-        parent = model.WikiContent.gql('WHERE title = :1', parent_title).get()
+        parent = model.WikiContent.get_by_title(parent_title, create_if_none=False)
         if parent is None:
             return False
 
     # Open editing is true; allow editing of anything that isn't locked
     # or otherwise blacklisted.
-    if settings.get('open-editing') == 'yes':
+    if policy.open_editing == 'yes':
         if not model.WikiContent.get_by_title(title).is_locked():
-            return not is_page_blacklisted(title)
+            return not policy.is_blacklisted(title)
 
     # Anonymous users can't edit anything
     if user is None:
@@ -51,8 +101,8 @@ def can_edit_page(title, user=None, is_admin=False):
 
     # If auth. editing enabled everywhere; make sure isn't blacklisted.
     # TODO: Why not check locks?
-    if settings.get('open-editing') == 'login':
-        return not is_page_blacklisted(title)
+    if policy.open_editing == 'login':
+        return not policy.is_blacklisted(title)
 
     # If person is explicitly listed as editor (and not blacklisted), then
     # allow. Replaced the editors[] with the editor_access.
@@ -76,33 +126,32 @@ def can_read_page(title, user, is_admin):
     Otherwise no access."""
     if is_admin:
         return True
-
-    is_user_reader = user and (user.email() in settings.get('readers', []) or user.email() in settings.get('editors', []))
-    if is_user_reader:
+    policy = get_policy()
+    if policy.is_reader(user):
         return True
+    return policy.can_read(model.WikiContent.get_by_title(title), user)
 
-    page = model.WikiContent.get_by_title(title)
-    options = util.parse_page(page.body or '')
 
-    is_open_wiki = settings.get('open-reading', 'yes') == 'yes'
-    if is_open_wiki:
-        if options.get('private') != 'yes':
-            return True
-        return user and (user.email() in options.get('readers', []) or user.email() in options.get('editors', []))
-    elif settings.get('open-reading') == 'login':
-        return options.get('public') == 'yes' or user
-    else:
-        return options.get('public') == 'yes'
+def filter_readable(pages, user, is_admin):
+    """Returns the pages that the user can read, checks only the access
+    properties stored with them."""
+    if is_admin:
+        return list(pages)
+    policy = get_policy()
+    if policy.is_reader(user):
+        return list(pages)
+    return [p for p in pages if policy.can_read(p, user)]
 
 
 def can_see_most_pages(user, is_admin):
     if is_admin:
         return True
-    if settings.get('open-reading', 'yes') == 'yes':
+    policy = get_policy()
+    if policy.open_reading == 'yes':
         return True
     if user is None:
         return False
-    if settings.get('open-reading') == 'login':
+    if policy.open_reading == 'login':
         return True
     #if user.email() in settings.get('readers', []):
     #    return True
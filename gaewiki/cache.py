@@ -0,0 +1,176 @@
+# encoding=utf-8
+
+"""Request-local storage for entities and values that should be loaded at
+most once per request.  The application clears it after every request;
+threadsafe instances serve each request in its own thread.
+
+Also keeps the memcache counters that other caches are stamped with."""
+
+import collections
+import gzip
+import random
+import StringIO
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+_request = threading.local()
+
+# Memcache entries rendered from pages live in a namespace named after this
+# counter, bumping it drops them all at once.
+GENERATION_KEY = 'gaewiki:generation'
+
+# Memcache values are limited to 1MB, larger ones are split into chunks.
+CHUNK_SIZE = 900 * 1024
+
+# Bumped whenever a page changes, and the time of that change.  Together
+# they make validators for anything rendered from pages.
+CHANGES_KEY = 'gaewiki:changes'
+CHANGED_AT_KEY = 'gaewiki:changed-at'
+
+
+def get_storage():
+    storage = getattr(_request, 'storage', None)
+    if storage is None:
+        storage = _request.storage = {}
+    return storage
+
+
+def contains(kind, key):
+    return (kind, key) in get_storage()
+
+
+def get(kind, key, default=None):
+    return get_storage().get((kind, key), default)
+
+
+def put(kind, key, value):
+    get_storage()[(kind, key)] = value
+    return value
+
+
+def forget(kind, key):
+    get_storage().pop((kind, key), None)
+
+
+def clear():
+    _request.storage = {}
+
+
+class LRU(object):
+    """A mapping that keeps up to size most recently used items, shared by
+    the threads of an instance."""
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+def get_counter(name):
+    """Returns the value of a memcache counter, asks memcache only once per
+    request.  A missing counter is restarted at a random value so that it's
+    not mistaken for a value seen before it was evicted."""
+    if not contains('counter', name):
+        value = memcache.get(name)
+        if value is None:
+            memcache.add(name, random.randint(1, 2 ** 30))
+            value = memcache.get(name)
+        put('counter', name, value)
+    return get('counter', name)
+
+
+def bump_counter(name):
+    """Increments a memcache counter and returns the new value."""
+    return put('counter', name, memcache.incr(name, initial_value=random.randint(1, 2 ** 30)))
+
+
+def get_namespace():
+    """Returns the memcache namespace for everything rendered from pages."""
+    return 'gaewiki-%s' % get_counter(GENERATION_KEY)
+
+
+def bump_generation():
+    """Invalidates everything rendered from pages at once."""
+    bump_counter(GENERATION_KEY)
+
+
+def note_change():
+    """Records that a page was changed."""
+    bump_counter(CHANGES_KEY)
+    put('counter', CHANGED_AT_KEY, time.time())
+    memcache.set(CHANGED_AT_KEY, get('counter', CHANGED_AT_KEY))
+
+
+def get_change_stamp():
+    """Returns the change counter and the time of the last change (None if
+    memcache forgot it)."""
+    if not contains('counter', CHANGED_AT_KEY):
+        put('counter', CHANGED_AT_KEY, memcache.get(CHANGED_AT_KEY))
+    return get_counter(CHANGES_KEY), get('counter', CHANGED_AT_KEY)
+
+
+def gzip_text(text):
+    data = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=data, mode='wb')
+    f.write(text.encode('utf-8'))
+    f.close()
+    return data.getvalue()
+
+
+def gunzip_text(data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read().decode('utf-8')
+
+
+def set_gzipped(key, data, namespace=None, version=None):
+    """Stores gzipped bytes in memcache, split into chunks if they don't fit
+    in one value.  The first value holds the version, the number of chunks
+    and a token that the other chunks must match."""
+    chunks = [data[idx:idx + CHUNK_SIZE] for idx in range(0, len(data), CHUNK_SIZE)] or ['']
+    token = random.randint(1, 2 ** 30)
+    values = {key: (version, token, len(chunks), chunks[0])}
+    for idx, chunk in enumerate(chunks[1:]):
+        values['%s#%u' % (key, idx + 1)] = (token, chunk)
+    if memcache.set_multi(values, namespace=namespace):
+        memcache.delete(key, namespace=namespace)
+
+
+def get_gzipped(key, namespace=None, version=None):
+    """Returns bytes stored by set_gzipped(), None if they're missing, were
+    stored for a different version or a chunk was evicted."""
+    head = memcache.get(key, namespace=namespace)
+    if head is None or head[0] != version:
+        return None
+    version, token, count, data = head
+    if count == 1:
+        return data
+    keys = ['%s#%u' % (key, idx) for idx in range(1, count)]
+    chunks = memcache.get_multi(keys, namespace=namespace)
+    parts = [data]
+    for chunk_key in keys:
+        chunk = chunks.get(chunk_key)
+        if chunk is None or chunk[0] != token:
+            return None
+        parts.append(chunk[1])
+    return ''.join(parts)
@@ -40,7 +40,7 @@ def wikify(text, page_title=None):
 
 
 def wikify_page(page):
-    return util.wikify_filter(page.body, page_name=page.title)
+    return page.get_html()
 
 
 def cleanup_summary(text):
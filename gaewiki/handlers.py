@@ -1,23 +1,32 @@
 # encoding=utf-8
 
+import itertools
 import logging
 import os
 import traceback
 import urllib
 
+import copy
+import email.utils
+import hashlib
 import json
+import StringIO
 import webapp2
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import blobstore
+from google.appengine.ext import db
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.runtime.apiproxy_errors import OverQuotaError
 
 import access
+import cache
 import images
 import model
+import search
 import settings
+import sitemap
 import util
 import view
 
@@ -36,10 +45,54 @@ class BadRequest(Exception):
 
 class RequestHandler(webapp2.RequestHandler):
     def reply(self, content, content_type='text/plain', status=200, save_as=None):
+        self.set_content_type(content_type, save_as)
+        self.response.out.write(content)
+
+    def set_content_type(self, content_type, save_as=None):
         self.response.headers['Content-Type'] = content_type + '; charset=utf-8'
         if save_as:
             self.response.headers['Content-Disposition'] = 'attachment; filename="%s"' % save_as
-        self.response.out.write(content)
+
+    def is_not_modified(self, version, last_modified=None, max_age=0):
+        """Sets validators for anonymous responses: an ETag made from version
+        and Last-Modified (a timestamp), and lets shared caches keep the
+        response for max_age seconds.  Returns True and sets up a 304
+        response if the client has this version already."""
+        if users.get_current_user() is not None:
+            return False
+        etag = '"%s"' % hashlib.sha1(repr(version)).hexdigest()
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = 'public, max-age=%u' % max_age
+        # Logged in users send the login cookie and must not get this copy.
+        self.add_vary('Cookie')
+        if last_modified is not None:
+            self.response.headers['Last-Modified'] = email.utils.formatdate(last_modified, usegmt=True)
+
+        match = self.request.headers.get('If-None-Match')
+        since = self.request.headers.get('If-Modified-Since')
+        if match is not None:
+            fresh = match.strip() == '*' or etag in [t.strip() for t in match.split(',')]
+        elif since is not None and last_modified is not None:
+            since = email.utils.parsedate_tz(since)
+            fresh = since is not None and int(last_modified) <= email.utils.mktime_tz(since)
+        else:
+            fresh = False
+        if fresh:
+            self.response.set_status(304)
+        return fresh
+
+    def add_vary(self, header):
+        """Adds a request header to the Vary response header."""
+        values = [v.strip() for v in self.response.headers.get('Vary', '').split(',') if v.strip()]
+        if header not in values:
+            values.append(header)
+        self.response.headers['Vary'] = ', '.join(values)
+
+    def get_feed_version(self):
+        """Returns the version of feeds and listings, which change with every
+        page."""
+        counter, changed_at = cache.get_change_stamp()
+        return (self.request.path_qs, counter, cache.get_namespace(), util.get_renderer_version()), changed_at
 
     def dump_request(self):
         for k in self.request.arguments():
@@ -91,19 +144,45 @@ class RequestHandler(webapp2.RequestHandler):
         return os.environ.get("HTTP_X_REQUESTED_WITH") == "XMLHttpRequest"
 
     def get_memcache(self, anon_only=False):
-        """memcache is active only anonymous user."""
-        content = None
-        user = users.get_current_user()
-        if not user and anon_only:
-            content = memcache.get(self.get_memcache_key())
-        if not content:
-            content = self.get_content()
-            if not user and anon_only:
-                memcache.set(self.get_memcache_key(), content)
-        return content
+        """memcache is active only anonymous user.  Cached content must be
+        text, it's stored gzipped."""
+        if anon_only and not users.get_current_user():
+            return cache.gunzip_text(self.get_cached_gzip())
+        return self.get_content()
+
+    def reply_memcache(self, content_type, anon_only=False):
+        """Replies with get_memcache(), clients that accept gzip get the
+        cached bytes as they are."""
+        if not anon_only or users.get_current_user():
+            return self.reply(self.get_content(), content_type)
+        data = self.get_cached_gzip()
+        self.set_content_type(content_type)
+        self.add_vary('Accept-Encoding')
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.response.headers['Content-Encoding'] = 'gzip'
+            self.response.out.write(data)
+        else:
+            self.response.out.write(cache.gunzip_text(data))
+
+    def get_cached_gzip(self):
+        key = self.get_memcache_key()
+        version = self.get_memcache_version()
+        data = cache.get_gzipped(key, namespace=cache.get_namespace(), version=version)
+        if data is None:
+            data = cache.gzip_text(self.get_content())
+            cache.set_gzipped(key, data, namespace=cache.get_namespace(), version=version)
+        return data
+
+    def get_memcache_version(self):
+        """Cached content is ignored once this changes.  Pages show other
+        pages (links, lists, the sidebar), so this changes with every
+        page."""
+        return cache.get_change_stamp()[0]
 
 
 class PageHandler(RequestHandler):
+    MAX_AGE = 60
+
     def get(self, page_name):
         try:
             self.show_page(urllib.unquote(page_name).decode('utf-8'))
@@ -119,12 +198,31 @@ class PageHandler(RequestHandler):
         self.raw = self.request.get("format") == "raw"
         self.revision = self.request.get("r")
 
+        page = model.WikiContent.get_by_title(self.title)
+        self.version = self.get_page_version(page)
+        if self.is_not_modified(self.version, cache.get_change_stamp()[1], self.MAX_AGE):
+            return
+
         if self.raw:
             body = self.get_memcache()
             content_type = str(body.get("content-type", "text/plain"))
             self.reply(body["text"], content_type=content_type)
         else:
-            self.reply(self.get_memcache(), 'text/html')
+            self.reply_memcache('text/html', anon_only=True)
+
+    def get_page_version(self, page):
+        """Returns the version of the page as shown.  Links and lists in the
+        body depend on other pages: those changes clear the stored HTML
+        from a task (see WikiContent.queue_flush), so the rendered HTML is part of
+        the version.  The sidebar and footer have their own counter."""
+        html = page.get_html() or u''
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        digest = hashlib.sha1(html).hexdigest()
+        return (self.title, self.raw, self.revision, page.updated, digest, cache.get_counter(util.FRAGMENTS_KEY), settings.get_version(), cache.get_namespace(), util.get_renderer_version())
+
+    def get_memcache_version(self):
+        return self.version
 
     def get_memcache_key(self):
         if self.raw:
@@ -143,7 +241,9 @@ class PageHandler(RequestHandler):
                 revision = model.WikiRevision.get_by_key(self.request.get("r"))
                 if revision is None:
                     raise NotFound("No such revision.")
-                page.body = revision.revision_body
+                # Don't change the page shared with the rest of the request.
+                page = copy.copy(page)
+                page.body = revision.get_body()
                 page.author = revision.author
                 page.updated = revision.created
             return view.view_page(page, user=users.get_current_user(), is_admin=users.is_current_user_admin(), revision=self.revision)
@@ -162,13 +262,15 @@ class EditHandler(RequestHandler):
         self.edit_page(title)
 
     def edit_page(self, title, body=None):
-        page = model.WikiContent.get_by_title(title)
-        if body:
-            page.body = body
         user = users.get_current_user()
         is_admin = users.is_current_user_admin()
         if not access.can_edit_page(title, user, is_admin):
             raise Forbidden
+        page = model.WikiContent.get_by_title(title)
+        if body:
+            # Previews must not leak into the page shared with the request.
+            page = copy.copy(page)
+            page.body = body
         if not body and not page.is_saved():
             page.load_template(user, is_admin)
         self.reply(view.edit_page(page), 'text/html')
@@ -185,87 +287,234 @@ class EditHandler(RequestHandler):
         page = model.WikiContent.get_by_title(title)
         new_content = self.request.get('body')
         page.update(body=new_content, author=user, delete=self.request.get('delete'))
-
-        memcache_key = 'Page:' + title
-        memcache.set(memcache_key, new_content)
         self.redirect('/' + urllib.quote(page.title.encode('utf-8').replace(' ', '_')))
         #taskqueue.add(url="/w/cache/purge", params={})
 
 
+def get_page_url(path, cursor=None, first=False, absolute=False, **params):
+    """Returns the URL of a page of a listing: the one that starts at the
+    cursor, or with first the first one.  Returns None if there's no such
+    page (no cursor, or first while on the first page)."""
+    if not (first or cursor):
+        return None
+    if cursor and not first:
+        params['cursor'] = cursor
+    url = path
+    if params:
+        url += '?' + urllib.urlencode([(k, unicode(v).encode('utf-8')) for k, v in sorted(params.items())])
+    if absolute:
+        url = util.get_base_url() + url
+    return url
+
+
+class TaskHandler(webapp2.RequestHandler):
+    """Base class for handlers that tasks POST to.  App Engine removes the
+    X-AppEngine-QueueName header from outside requests, so other POSTs are
+    rejected."""
+    def dispatch(self):
+        if self.request.method == 'POST' and 'X-AppEngine-QueueName' not in self.request.headers:
+            self.abort(403)
+        return super(TaskHandler, self).dispatch()
+
+
 def PurgePage(page):
-    memcache.delete('Page:' + page.title)
-    memcache.delete('RawPage:' + page.title)
-    memcache.delete('PageHistory:' + page.title)
-    memcache.delete('BackLinks:' + page.title)
-    for label in page.labels:
-        memcache.delete('PagesFeed:' + label)
+    memcache.delete_multi(page.get_cache_keys(), namespace=cache.get_namespace())
+
 
+class CachePurgeHandler(TaskHandler):
+    """Purges cached pages.  By default walks all pages in a chain of tasks,
+    BATCH_SIZE pages each.  With mode=generation it switches to a new
+    memcache namespace instead, which drops everything at once."""
+    BATCH_SIZE = 200
 
-class CachePurgeHandler(webapp2.RequestHandler):
     def get(self):
         if users.is_current_user_admin():
-            taskqueue.add(url="/w/cache/purge", params={})
+            taskqueue.add(url="/w/cache/purge", params={'mode': self.request.get('mode')})
 
     def post(self):
-        memcache.delete('Index:')
-        memcache.delete('IndexFeed:')
-        memcache.delete('Sitemap:')
-        memcache.delete('Changes:')
-        memcache.delete('ChangesFeed:')
-        for page in model.WikiContent.all():
-            PurgePage(page)
+        if self.request.get('mode') == 'generation':
+            cache.bump_generation()
+            return
+
+        namespace = cache.get_namespace()
+        query = model.WikiContent.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        else:
+            memcache.delete_multi(['Index:', 'IndexFeed:', 'Sitemap:', 'Changes:', 'ChangesFeed:'], namespace=namespace)
+
+        pages = query.fetch(self.BATCH_SIZE)
+        keys = []
+        for page in pages:
+            keys.extend(page.get_cache_keys())
+        memcache.delete_multi(keys, namespace=namespace)
+        logging.debug('Purged cache for %u pages.' % len(pages))
+
+        if len(pages) == self.BATCH_SIZE:
+            taskqueue.add(url="/w/cache/purge", params={'cursor': query.cursor()})
+
+
+class CacheFlushHandler(TaskHandler):
+    """Flushes pages that depend on changed titles or labels, queued by
+    WikiContent.queue_flush.  Each task handles one batch and queues the
+    next one."""
+    def post(self):
+        data = json.loads(self.request.get('data'))
+        position = int(self.request.get('position') or 0)
+        cursor = self.request.get('cursor') or None
+        result = model.WikiContent.flush_dependents(data['titles'], data['labels'], exclude=data['exclude'], position=position, cursor=cursor)
+        if result is not None:
+            position, cursor = result
+            taskqueue.add(url="/w/cache/flush", params={'data': self.request.get('data'), 'position': position, 'cursor': cursor or ''})
+
+
+class RekeyHandler(TaskHandler):
+    """Moves pages to title-derived keys, one batch per task.  Once done,
+    title lookups stop falling back to queries and label indexes are
+    dropped to be rebuilt from the updated pages."""
+    BATCH_SIZE = 100
+
+    def get(self):
+        if users.is_current_user_admin():
+            taskqueue.add(url="/w/data/rekey", params={})
+
+    def post(self):
+        query = model.WikiContent.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        pages = query.fetch(self.BATCH_SIZE)
+        moved = model.WikiContent.rekey_pages(pages)
+        logging.info('Moved %u of %u pages to title keys.' % (moved, len(pages)))
+        if len(pages) == self.BATCH_SIZE:
+            taskqueue.add(url="/w/data/rekey", params={'cursor': query.cursor()})
+        else:
+            settings.change({'title-keys': 'yes'})
+            model.WikiLabelIndex.drop_all()
 
 
 class IndexHandler(RequestHandler):
     def get(self):
         self.check_open_wiki()
+        self.cursor = self.request.get('cursor')
         self.reply(self.get_memcache(), 'text/html')
 
     def get_memcache_key(self):
-        return 'Index:'
+        return 'Index:' + self.cursor
 
     def get_content(self):
-        return view.list_pages(model.WikiContent.get_all())
+        pages, next_cursor = model.WikiContent.get_index_page(self.cursor or None)
+        return view.list_pages(pages, get_page_url('/w/index', first=self.cursor), get_page_url('/w/index', next_cursor))
+
+
+class LabelPagesHandler(RequestHandler):
+    """Lists pages with a label, continues where [[List:]] stops."""
+    def get(self):
+        self.check_open_wiki()
+        label = self.request.get('label')
+        sort = self.request.get('sort')
+        cursor = self.request.get('cursor')
+        pages, next_cursor = model.WikiContent.get_label_page(label, cursor or None, newest_first=sort == 'date,desc')
+        params = dict([(k, v) for k, v in (('label', label), ('sort', sort)) if v])
+        self.reply(view.list_pages(pages, get_page_url('/w/pages', first=cursor, **params), get_page_url('/w/pages', next_cursor, **params), label=label), 'text/html')
+
+
+class SearchHandler(RequestHandler):
+    def get(self):
+        self.check_open_wiki()
+        query = self.request.get('q')
+        results = []
+        if query:
+            results = search.search(query, users.get_current_user(), users.is_current_user_admin())
+        self.reply(view.show_search_results(query, results), 'text/html')
+
+
+class CompleteHandler(RequestHandler):
+    """Returns titles that start with q as a JSON list, for autocompletion."""
+    def get(self):
+        self.check_open_wiki()
+        self.reply(json.dumps(search.complete(self.request.get('q'))), 'application/json')
+
+
+class SearchIndexHandler(TaskHandler):
+    """Updates the search index for the pages named in the task.  A GET by an
+    admin (re)indexes all pages, one batch per task."""
+    BATCH_SIZE = 100
+
+    def get(self):
+        if users.is_current_user_admin():
+            taskqueue.add(url="/w/search/index", params={'all': 1})
+
+    def post(self):
+        if not self.request.get('all'):
+            search.update_index(self.request.get_all('title'))
+            return
+        query = model.WikiContent.all(keys_only=True)
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(self.BATCH_SIZE)
+        search.update_index([p.title for p in db.get(keys) if p is not None])
+        if len(keys) == self.BATCH_SIZE:
+            taskqueue.add(url="/w/search/index", params={'all': 1, 'cursor': query.cursor()})
 
 
 class IndexFeedHandler(RequestHandler):
+    MAX_AGE = 300
+
     def get(self):
         self.check_open_wiki()
-        self.reply(self.get_memcache(), 'application/atom+xml')
+        if self.is_not_modified(*self.get_feed_version(), max_age=self.MAX_AGE):
+            return
+        self.cursor = self.request.get('cursor')
+        self.reply_memcache('application/atom+xml', anon_only=True)
 
     def get_memcache_key(self):
-        return 'IndexFeed:'
+        return 'IndexFeed:' + self.cursor
 
     def get_content(self):
-        return view.list_pages_feed(model.WikiContent.get_recently_added())
+        pages, next_cursor = model.WikiContent.get_recently_added(self.cursor or None)
+        return view.list_pages_feed(pages, get_page_url('/w/index.rss', next_cursor, absolute=True))
 
 
 class PagesFeedHandler(RequestHandler):
+    MAX_AGE = 300
+
     def get(self):
         self.check_open_wiki()
+        if self.is_not_modified(*self.get_feed_version(), max_age=self.MAX_AGE):
+            return
         self.label = self.request.get('label')
-        self.reply(self.get_memcache(), 'application/atom+xml')
+        self.cursor = self.request.get('cursor')
+        self.reply_memcache('application/atom+xml', anon_only=True)
 
     def get_memcache_key(self):
+        if self.cursor:
+            return 'PagesFeed:%s:%s' % (self.label, self.cursor)
         return 'PagesFeed:' + self.label
 
     def get_content(self):
-        return view.list_pages_feed(model.WikiContent.get_recent_by_label(self.label))
+        pages, next_cursor = model.WikiContent.get_recent_by_label(self.label, self.cursor or None)
+        return view.list_pages_feed(pages, get_page_url('/w/pages.rss', next_cursor, absolute=True, label=self.label))
 
 
 class PageHistoryHandler(RequestHandler):
     def get(self):
-        self.title = self.request.get('page')
+        self.title = self.request.get('page').replace('_', ' ')
+        self.cursor = self.request.get('cursor')
         if not access.can_read_page(self.title, users.get_current_user(), users.is_current_user_admin()):
             raise Forbidden
         self.reply(self.get_memcache(), 'text/html')
 
     def get_memcache_key(self):
+        if self.cursor:
+            return 'PageHistory:%s:%s' % (self.title, self.cursor)
         return 'PageHistory:' + self.title
 
     def get_content(self):
         page = model.WikiContent.get_by_title(self.title)
-        return view.show_page_history(page, user=users.get_current_user(), is_admin=users.is_current_user_admin())
+        return view.show_page_history(page, user=users.get_current_user(), is_admin=users.is_current_user_admin(), cursor=self.cursor or None)
 
 
 class RobotsHandler(RequestHandler):
@@ -278,15 +527,45 @@ class RobotsHandler(RequestHandler):
 
 
 class SitemapHandler(RequestHandler):
+    """Serves the sitemap index, which lists the shards built so far."""
     def get(self):
         self.check_open_wiki()
-        self.reply(self.get_memcache(), 'text/xml')
+        shards = sitemap.get_shards()
+        base = util.get_base_url()
+        if [s for s in shards if s is None or s.base != base]:
+            sitemap.queue_build(base=base)
+        shards = [(idx, s) for idx, s in enumerate(shards) if s is not None and s.count]
+        self.reply(view.get_sitemap_index(shards), 'text/xml')
 
-    def get_memcache_key(self):
-        return 'Sitemap:'
 
-    def get_content(self):
-        return view.get_sitemap(model.WikiContent.get_publicly_readable())
+class SitemapShardHandler(RequestHandler):
+    def get(self, shard):
+        self.check_open_wiki()
+        shard = int(shard)
+        entity = None
+        if shard < sitemap.SHARDS:
+            entity = sitemap.get_shards()[shard]
+        if entity is None:
+            raise NotFound('No such sitemap.')
+        self.response.headers['Content-Type'] = 'application/x-gzip'
+        self.response.out.write(entity.data)
+
+
+class SitemapBuildHandler(TaskHandler):
+    """Rebuilds a sitemap shard.  A GET by an admin rebuilds all of them."""
+    def get(self):
+        if users.is_current_user_admin():
+            sitemap.queue_build()
+
+    def post(self):
+        shard = int(self.request.get('shard'))
+        base = self.request.get('base')
+        if not base:
+            entity = sitemap.get_shards()[shard]
+            base = entity and entity.base or util.get_base_url()
+        pages = sitemap.get_pages(shard)
+        sitemap.store(shard, view.get_sitemap(pages, base), len(pages), base)
+        logging.info('Sitemap shard %u has %u pages.' % (shard, len(pages)))
 
 
 class ChangesHandler(RequestHandler):
@@ -296,28 +575,35 @@ class ChangesHandler(RequestHandler):
         self.reply(self.get_memcache(), 'text/html')
 
     def get_memcache_key(self):
-        return 'Changes:'
+        return 'Changes:' + self.request.get('cursor')
 
     def get_content(self):
-        return view.get_change_list(model.WikiContent.get_changes())
+        cursor = self.request.get('cursor')
+        pages, next_cursor = model.WikiContent.get_changes(cursor or None)
+        return view.get_change_list(pages, get_page_url('/w/changes', first=cursor), get_page_url('/w/changes', next_cursor))
 
 
 class ChangesFeedHandler(RequestHandler):
+    MAX_AGE = 300
+
     def get(self):
         if not access.can_see_most_pages(users.get_current_user(), users.is_current_user_admin()):
             raise Forbidden
-        self.reply(self.get_memcache(), 'text/xml')
+        if self.is_not_modified(*self.get_feed_version(), max_age=self.MAX_AGE):
+            return
+        self.reply_memcache('text/xml', anon_only=True)
 
     def get_memcache_key(self):
-        return 'ChangesFeed:'
+        return 'ChangesFeed:' + self.request.get('cursor')
 
     def get_content(self):
-        return view.get_change_feed(model.WikiContent.get_changes())
+        pages, next_cursor = model.WikiContent.get_changes(self.request.get('cursor') or None)
+        return view.get_change_feed(pages, get_page_url('/w/changes.rss', next_cursor, absolute=True))
 
 
 class BackLinksHandler(RequestHandler):
     def get(self):
-        self.title = self.request.get('page')
+        self.title = self.request.get('page').replace('_', ' ')
         if not access.can_read_page(self.title, users.get_current_user(), users.is_current_user_admin()):
             raise Forbidden
         self.reply(self.get_memcache(), 'text/html')
@@ -330,6 +616,47 @@ class BackLinksHandler(RequestHandler):
         return view.get_backlinks(page, page.get_backlinks())
 
 
+class DiffHandler(RequestHandler):
+    """Compares two revisions of a page, from and to are revision keys, an
+    empty one stands for the current page.  Diffs are cached by the pair of
+    keys, revisions never change."""
+    def get(self):
+        title = self.request.get('page').replace('_', ' ')
+        if not access.can_read_page(title, users.get_current_user(), users.is_current_user_admin()):
+            raise Forbidden
+        page = model.WikiContent.get_by_title(title)
+        old = self.get_revision(page, 'from')
+        new = self.get_revision(page, 'to')
+
+        key = 'Diff:%s:%s' % (self.get_version(page, old), self.get_version(page, new))
+        rows = memcache.get(key)
+        if rows is None:
+            rows = util.diff_texts(self.get_body(page, old), self.get_body(page, new))
+            memcache.set(key, rows)
+        self.reply(view.show_diff(page, old, new, rows), 'text/html')
+
+    def get_revision(self, page, name):
+        if not self.request.get(name):
+            return None
+        try:
+            revision = model.WikiRevision.get_by_key(self.request.get(name))
+        except db.BadKeyError:
+            raise BadRequest
+        if revision is None or revision.title != page.title:
+            raise NotFound('No such revision.')
+        return revision
+
+    def get_version(self, page, revision):
+        if revision is None:
+            return 'page@%s:%s' % (page.updated, page.title)
+        return str(revision.key())
+
+    def get_body(self, page, revision):
+        if revision is None:
+            return page.body or u''
+        return revision.get_body()
+
+
 class UsersHandler(RequestHandler):
   def get(self):
     if not users.get_current_user():
@@ -372,40 +699,202 @@ class UsersHandler(RequestHandler):
       if any_changes:
         user.put()
 
-    taskqueue.add(url="/w/cache/purge", params={})
+    cache.bump_generation()
     self.redirect('/w/users')
 
 
 class DataExportHandler(RequestHandler):
+    """Exports the wiki as JSON, a dictionary of pages by title which the
+    import handler reads, or with format=ndjson as one JSON record per line.
+    NDJSON exports can also include revisions (revisions=1) and users
+    (users=1).  The export is split into parts of up to PAGE_SIZE records,
+    so that each response stays small: the URL of the next part is sent in
+    a Link header, and NDJSON parts end with a "next" record which the
+    importer skips."""
+    PAGE_SIZE = 100
+
     def get(self):
         if not users.is_current_user_admin():
             raise Forbidden
-        pages = dict([(p.title, {
-            'author': p.author and p.author.wiki_user.email(),
-            'updated': p.updated.strftime('%Y-%m-%d %H:%M:%S'),
-            'body': p.body,
-        }) for p in model.WikiContent.get_all()])
-        self.reply(json.dumps(pages), 'application/json', save_as='gae-wiki.json')
+        self.ndjson = self.request.get('format') == 'ndjson'
+        parts = ['pages']
+        if self.ndjson:
+            parts += [p for p in ('revisions', 'users') if self.request.get(p)]
+        part = self.request.get('part') or 'pages'
+        if part not in parts:
+            raise NotFound
+
+        if self.ndjson:
+            self.set_content_type('application/x-ndjson', save_as='gae-wiki.ndjson')
+        else:
+            self.set_content_type('application/json', save_as='gae-wiki.json')
+            self.response.out.write('{')
+
+        self.first = True
+        cursor = getattr(self, 'export_' + part)(self.request.get('cursor') or None)
+
+        next_url = None
+        if cursor:
+            next_url = self.get_part_url(part, cursor)
+        elif parts.index(part) + 1 < len(parts):
+            next_url = self.get_part_url(parts[parts.index(part) + 1], None)
+        if next_url:
+            self.response.headers['Link'] = '<%s>; rel="next"' % next_url
+            if self.ndjson:
+                self.write_record('next', next_url, {})
+        if not self.ndjson:
+            self.response.out.write('}')
+
+    def get_part_url(self, part, cursor):
+        params = [(k, self.request.get(k)) for k in ('format', 'revisions', 'users') if self.request.get(k)]
+        params.append(('part', part))
+        if cursor:
+            params.append(('cursor', cursor))
+        return self.request.host_url + self.request.path + '?' + urllib.urlencode(params)
+
+    def export_pages(self, cursor):
+        pages, cursor = model.fetch_page(model.WikiContent.all(), cursor, self.PAGE_SIZE)
+        authors = model.get_authors(pages)
+        for page in pages:
+            self.write_record('page', page.title, {
+                'author': self.get_email(authors, model.WikiContent.author.get_value_for_datastore(page)),
+                'updated': page.updated.strftime('%Y-%m-%d %H:%M:%S'),
+                'body': page.body,
+            })
+        return cursor
+
+    def export_revisions(self, cursor):
+        """Exports revisions by title, newest first, so that the bodies of
+        deltas are rebuilt along the chain (see WikiRevision.get_bodies)."""
+        query = model.WikiRevision.all().order('title').order('-created')
+        revisions, cursor = model.fetch_page(query, cursor, self.PAGE_SIZE)
+        authors = model.get_authors(revisions)
+        for revision, body in zip(revisions, model.WikiRevision.get_bodies(revisions)):
+            self.write_record('revision', revision.title, {
+                'author': self.get_email(authors, model.WikiRevision.author.get_value_for_datastore(revision)),
+                'created': revision.created.strftime('%Y-%m-%d %H:%M:%S'),
+                'body': body,
+            })
+        return cursor
+
+    def export_users(self, cursor):
+        wiki_users, cursor = model.fetch_page(model.WikiUser.all(), cursor, self.PAGE_SIZE)
+        for wiki_user in wiki_users:
+            self.write_record('user', wiki_user.wiki_user.email(), {
+                'nickname': wiki_user.nickname,
+                'public_email': wiki_user.public_email,
+                'joined': wiki_user.joined.strftime('%Y-%m-%d %H:%M:%S'),
+                'editor_access': wiki_user.editor_access,
+                'staff_access': wiki_user.staff_access,
+            })
+        return cursor
+
+    def write_record(self, kind, name, record):
+        if self.ndjson:
+            record['kind'] = kind
+            record['name'] = name
+            self.response.out.write(json.dumps(record) + '\n')
+        else:
+            if not self.first:
+                self.response.out.write(',')
+            self.response.out.write(json.dumps(name) + ':' + json.dumps(record))
+        self.first = False
+
+    def get_email(self, authors, key):
+        if key in authors:
+            return authors[key].wiki_user.email()
+        return None
 
 
 class DataImportHandler(RequestHandler):
+    """Imports data written by DataExportHandler.  The upload is split into
+    chunks of up to CHUNK_SIZE pages and CHUNK_BYTES of JSON (entities are
+    limited to 1MB) which a chain of tasks imports one by one, the form
+    shows the progress of the job."""
+    CHUNK_SIZE = 100
+    CHUNK_BYTES = 900 * 1024
+
     def get(self):
         if not users.is_current_user_admin():
             raise Forbidden
-        self.reply(view.get_import_form(), 'text/html')
+        job = None
+        if self.request.get('job'):
+            job = model.WikiImport.get(self.request.get('job'))
+        self.reply(view.get_import_form(job), 'text/html')
 
     def post(self):
         if not users.is_current_user_admin():
             raise Forbidden
-        merge = self.request.get('merge') != ''
-
-        loaded = json.loads(self.request.get('file'))
-        for title, content in loaded.items():
-            page = model.WikiContent.get_by_title(title)
-            author = content['author'] and users.User(content['author'])
-            page.update(content['body'], author, False)
+        job = model.WikiImport(merge=self.request.get('merge') != '')
+        job.put()
+
+        for data in self.read_chunks(self.request.get('file')):
+            key_name = model.WikiImportChunk.key_name_for(job.chunks)
+            model.WikiImportChunk(parent=job, key_name=key_name, records=data).put()
+            job.chunks += 1
+        job.put()
+
+        if job.chunks:
+            DataImportTaskHandler.queue(job, 0)
+        self.redirect('/w/data/import?job=' + str(job.key()))
+
+    def read_chunks(self, data):
+        """Yields JSON lists of up to CHUNK_SIZE page records and CHUNK_BYTES
+        (a bigger record gets a chunk of its own).  NDJSON uploads are
+        parsed a line at a time, other records than pages are skipped."""
+        stream = StringIO.StringIO(data)
+        first = stream.readline()
+        try:
+            loaded = json.loads(first)
+        except ValueError:
+            loaded = None
+        if isinstance(loaded, dict) and 'kind' in loaded and 'name' in loaded:
+            lines = itertools.chain([first], stream)
+            records = (json.loads(line) for line in lines if line.strip())
+            records = ({'title': r['name'], 'author': r.get('author'), 'body': r['body']} for r in records if r['kind'] == 'page')
+        else:
+            if loaded is None or stream.read(1):
+                loaded = json.loads(data)
+            records = ({'title': t, 'author': c['author'], 'body': c['body']} for t, c in loaded.items())
+
+        chunk, size = [], 2
+        for record in records:
+            encoded = json.dumps(record)
+            if chunk and (len(chunk) == self.CHUNK_SIZE or size + len(encoded) + 1 > self.CHUNK_BYTES):
+                yield '[' + ','.join(chunk) + ']'
+                chunk, size = [], 2
+            chunk.append(encoded)
+            size += len(encoded) + 1
+        if chunk:
+            yield '[' + ','.join(chunk) + ']'
+
+
+class DataImportTaskHandler(TaskHandler):
+    """Imports one chunk of a data import and queues the next one.  The
+    chunk is deleted once imported; if the task fails it's retried, which
+    is safe because importing the same records again changes nothing."""
+    def post(self):
+        job = model.WikiImport.get(self.request.get('job'))
+        number = int(self.request.get('chunk'))
+        chunk = model.WikiImportChunk.get_by_key_name(model.WikiImportChunk.key_name_for(number), parent=job)
+        if chunk is not None:
+            count = model.WikiContent.import_records(json.loads(chunk.records), merge=job.merge)
+            db.run_in_transaction(model.WikiImport.finish_chunk, job.key(), number, count)
+            logging.info('Imported %u pages from chunk %u of %u.' % (count, number + 1, job.chunks))
+
+        if number + 1 < job.chunks:
+            self.queue(job, number + 1)
+        else:
+            cache.bump_generation()
 
-        self.reply("Done.")
+    @staticmethod
+    def queue(job, number):
+        """Queues the import of a chunk; tasks are named so that a chunk is
+        queued only once."""
+        try:
+            taskqueue.add(url="/w/data/import/task", params={'job': str(job.key()), 'chunk': number}, name='import-%u-%u' % (job.key().id(), number))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
 
 
 class ProfileHandler(RequestHandler):
@@ -491,22 +980,32 @@ handlers = [
     ('/', StartPageHandler),
     ('/robots\.txt$', RobotsHandler),
     ('/sitemap\.xml$', SitemapHandler),
+    ('/sitemap-(\d+)\.xml\.gz$', SitemapShardHandler),
     ('/w/backlinks$', BackLinksHandler),
     ('/w/changes$', ChangesHandler),
     ('/w/changes\.rss$', ChangesFeedHandler),
     ('/w/data/export$', DataExportHandler),
     ('/w/data/import$', DataImportHandler),
+    ('/w/data/import/task$', DataImportTaskHandler),
+    ('/w/data/rekey$', RekeyHandler),
+    ('/w/complete$', CompleteHandler),
+    ('/w/diff$', DiffHandler),
     ('/w/edit$', EditHandler),
     ('/w/history$', PageHistoryHandler),
+    ('/w/search$', SearchHandler),
+    ('/w/sitemap/build$', SitemapBuildHandler),
+    ('/w/search/index$', SearchIndexHandler),
     ('/w/image/upload', ImageUploadHandler),
     ('/w/image/view', ImageServeHandler),
     ('/w/image/list', ImageListHandler),
     ('/w/index$', IndexHandler),
     ('/w/index\.rss$', IndexFeedHandler),
+    ('/w/pages$', LabelPagesHandler),
     ('/w/pages\.rss', PagesFeedHandler),
     ('/w/profile', ProfileHandler),
     ('/w/users$', UsersHandler),
     ('/w/login', LoginHandler),
     ('/w/cache/purge$', CachePurgeHandler),
+    ('/w/cache/flush$', CacheFlushHandler),
     ('/(.+)$', PageHandler),
 ]
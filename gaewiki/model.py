@@ -1,18 +1,105 @@
 # encoding=utf-8
 
 import datetime
+import hashlib
+import json
 import logging
 import random
 import re
+import zlib
 
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import db
 
+import cache
+import search
 import settings
+import sitemap
 import util
 
 
+# The datastore does not allow more values in a single IN filter.
+MAX_IN_VALUES = 30
+
+# Set while a /w/data/rekey task is queued, see WikiContent.queue_rekey().
+REKEY_QUEUED_KEY = 'gaewiki:rekey-queued'
+REKEY_RETRY = 3600
+_rekey_queued = False
+
+# Page header syntax, see WikiContent.parse_body().
+HEADER_SEPARATOR = re.compile(r'[\r\n]+---[\r\n]+')
+LINE_BREAKS = re.compile(r'[\r\n]+')
+LIST_SEPARATOR = re.compile(r',\s*')
+
+# Parsed headers by body hash, as (properties, offset of the text).  The text
+# is not kept, it's sliced from the body.  Values are shared, copy before
+# returning.
+parsed_bodies = cache.LRU(256)
+
+
+def fetch_batches(query, size):
+    """Walks the query with cursors, yields lists of up to size entities."""
+    while True:
+        batch = query.fetch(size)
+        if batch:
+            yield batch
+        if len(batch) < size:
+            break
+        query.with_cursor(query.cursor())
+
+
+def fetch_page(query, cursor=None, limit=100):
+    """Fetches up to limit results starting at the cursor.  Returns them and
+    the cursor of the next page, None if this is the last one."""
+    if cursor:
+        query.with_cursor(cursor)
+    results = query.fetch(limit)
+    if len(results) < limit:
+        return results, None
+    return results, query.cursor()
+
+
+def get_authors(entities):
+    """Loads the authors of pages or revisions with one batch get.  Returns a
+    dictionary that maps author keys to WikiUser entities."""
+    keys = set([type(e).author.get_value_for_datastore(e) for e in entities])
+    keys = list(keys - set([None]))
+    return dict([(k, u) for k, u in zip(keys, db.get(keys)) if u is not None])
+
+
+def prefetch_authors(entities):
+    """Loads the authors of pages or revisions with one batch get and stores
+    them in the author properties, so that templates don't load them one by
+    one.  Authors that no longer exist are replaced with None.  Returns the
+    entities."""
+    authors = get_authors(entities)
+    for entity in entities:
+        key = type(entity).author.get_value_for_datastore(entity)
+        if key is not None:
+            entity.author = authors.get(key)
+    return entities
+
+
+class NicknameTaken(RuntimeError):
+    pass
+
+
+class WikiNickname(db.Model):
+    """Reserves a nickname for a user.  The key name is the lowercase
+    nickname, so uniqueness is checked with a get in the transaction that
+    saves the user."""
+    owner = db.StringProperty()
+
+
 class WikiUser(db.Model):
+    """Wiki users are stored under a key derived from the user id, see
+    key_name_for().  Users created before that have numeric ids and are
+    found with a query once, then from memcache."""
+    # Random suffixes tried for a new user whose nickname is taken.
+    NICKNAME_ATTEMPTS = 10
+
     wiki_user = db.UserProperty()
     joined = db.DateTimeProperty(auto_now_add=True)
     wiki_user_picture = db.BlobProperty()
@@ -24,6 +111,11 @@ class WikiUser(db.Model):
     staff_access = db.BooleanProperty(verbose_name='Ascendant Staff',
                                        default=False, required=True)
 
+    def __init__(self, *args, **kwargs):
+        super(WikiUser, self).__init__(*args, **kwargs)
+        # The nickname reserved in the datastore.
+        self._stored_nickname = self.nickname
+
     def get_nickname(self):
         if self.nickname:
             return self.nickname
@@ -33,11 +125,42 @@ class WikiUser(db.Model):
         return self.public_email or self.wiki_user.email()
 
     def put(self):
-        if self.nickname:
+        """Saves the user and reserves the nickname in one transaction,
+        raises NicknameTaken if another user has it."""
+        if self.nickname and self.nickname != self._stored_nickname:
+            # Nicknames of old users have no WikiNickname entities.
             other = self.gql('WHERE nickname = :1', self.nickname).get()
-            if other is not None and other.key() != self.key():
-                raise RuntimeError('This nickname is already taken, please choose a different one.')
-        return super(WikiUser, self).put()
+            if other is not None and (not self.is_saved() or other.key() != self.key()):
+                raise NicknameTaken('This nickname is already taken, please choose a different one.')
+        options = db.create_transaction_options(xg=True)
+        key = db.run_in_transaction_options(options, self._put_with_nickname)
+        self._stored_nickname = self.nickname
+        memcache.set(self.memcache_key_for(self.wiki_user), self)
+        return key
+
+    def _put_with_nickname(self):
+        if self.nickname == self._stored_nickname:
+            return super(WikiUser, self).put()
+        if self.nickname:
+            name = WikiNickname.get_by_key_name(self.nickname.lower())
+            if name is not None and (not self.has_key() or name.owner != str(self.key())):
+                raise NicknameTaken('This nickname is already taken, please choose a different one.')
+        key = super(WikiUser, self).put()
+        if self.nickname:
+            WikiNickname(key_name=self.nickname.lower(), owner=str(key)).put()
+        if self._stored_nickname and self._stored_nickname.lower() != (self.nickname or '').lower():
+            db.delete(db.Key.from_path('WikiNickname', self._stored_nickname.lower()))
+        return key
+
+    @staticmethod
+    def key_name_for(user):
+        if user.user_id():
+            return 'user:' + user.user_id()
+        return 'email:' + user.email().lower()
+
+    @staticmethod
+    def memcache_key_for(user):
+        return 'WikiUser:' + WikiUser.key_name_for(user)
 
     @classmethod
     def get_all(cls, limit=1000):
@@ -45,21 +168,74 @@ class WikiUser(db.Model):
 
     @classmethod
     def get_or_create(cls, user):
+        """Returns the WikiUser for a user, from the request cache or
+        memcache if possible, creates it on first login."""
         if not user:
             return None
-        wiki_user = cls.gql('WHERE wiki_user = :1', user).get()
+        wiki_user = cache.get('WikiUser', user.email())
+        if wiki_user is None:
+            wiki_user = memcache.get(cls.memcache_key_for(user))
         if wiki_user is None:
-            wiki_user = cls(wiki_user=user)
-            wiki_user.nickname = cls.get_unique_nickname(wiki_user)
-            wiki_user.put()
-        return wiki_user
+            wiki_user = cls.load(user)
+            if wiki_user is not None and user.user_id() and wiki_user.wiki_user.user_id() != user.user_id():
+                # Store the user id so that put() refreshes the right entry.
+                wiki_user.wiki_user = user
+                wiki_user.put()
+            elif wiki_user is not None:
+                memcache.set(cls.memcache_key_for(user), wiki_user)
+        if wiki_user is None:
+            wiki_user = cls.create(user)
+        return cache.put('WikiUser', user.email(), wiki_user)
+
+    @classmethod
+    def load(cls, user):
+        """Finds a stored user: by user id, by email (users imported before
+        they logged in), then by a query for old users."""
+        key_names = [cls.key_name_for(user)]
+        if user.user_id():
+            key_names.append('email:' + user.email().lower())
+        for wiki_user in cls.get_by_key_name(key_names):
+            if wiki_user is not None:
+                return wiki_user
+        return cls.gql('WHERE wiki_user = :1', user).get()
+
+    @classmethod
+    def create(cls, user):
+        """Saves a new user with a unique nickname: the email name, or that
+        with a random number added."""
+        wiki_user = cls(key_name=cls.key_name_for(user), wiki_user=user)
+        nickname = wiki_user.get_nickname()
+        for attempt in range(cls.NICKNAME_ATTEMPTS):
+            wiki_user.nickname = nickname
+            try:
+                wiki_user.put()
+                return wiki_user
+            except NicknameTaken:
+                nickname = wiki_user.wiki_user.email().split('@', 1)[0] + str(random.randrange(1111, 9999))
+        raise NicknameTaken('Could not find a free nickname for %s.' % user.email())
 
     @classmethod
-    def get_unique_nickname(cls, user):
-        nickname = user.get_nickname()
-        while cls.gql('WHERE nickname = :1', nickname).get() is not None:
-            nickname = user.get_nickname() + str(random.randrange(1111, 9999))
-        return nickname
+    def get_or_create_many(cls, user_list):
+        """Resolves many users with IN queries, creating the missing ones.
+        Returns a dictionary that maps emails to WikiUser entities."""
+        found = {}
+        pending = []
+        for user in user_list:
+            if cache.contains('WikiUser', user.email()):
+                found[user.email()] = cache.get('WikiUser', user.email())
+            elif user.email() not in [u.email() for u in pending]:
+                pending.append(user)
+        for user, wiki_user in zip(pending, cls.get_by_key_name([cls.key_name_for(u) for u in pending])):
+            if wiki_user is not None:
+                found[user.email()] = cache.put('WikiUser', user.email(), wiki_user)
+        pending = [u for u in pending if u.email() not in found]
+        for idx in range(0, len(pending), MAX_IN_VALUES):
+            for wiki_user in cls.gql('WHERE wiki_user IN :1', pending[idx:idx + MAX_IN_VALUES]):
+                found[wiki_user.wiki_user.email()] = cache.put('WikiUser', wiki_user.wiki_user.email(), wiki_user)
+        for user in pending:
+            if user.email() not in found:
+                found[user.email()] = cls.get_or_create(user)
+        return found
 
 
 class WikiUserReference(db.ReferenceProperty):
@@ -77,6 +253,8 @@ class WikiUserReference(db.ReferenceProperty):
 class WikiContent(db.Model):
     """Stores current versions of pages."""
     GEOLABEL = 'gaewiki:geopt'
+    FLUSH_BATCH_SIZE = 100
+    FLUSH_TRANSACTION_SIZE = 25
 
     title = db.StringProperty(required=True)
     body = db.TextProperty(required=False)
@@ -92,10 +270,32 @@ class WikiContent(db.Model):
     labels = db.StringListProperty()
     # Pages that this one links to.
     links = db.StringListProperty()
+    # The title that listings sort by, see get_sort_title().
+    sort_title = db.StringProperty()
+    # The sitemap that lists this page, see sitemap.get_shard().
+    sitemap_shard = db.IntegerProperty()
+    # Access control properties copied from the body, see get_acl().
+    # Readers include editors.
+    private = db.BooleanProperty()
+    public = db.BooleanProperty()
+    readers = db.StringListProperty()
+    locked = db.BooleanProperty()
+    # Rendered body, the renderer version that made it and the things it
+    # depends on (see util.extract_dependencies).
+    html = db.TextProperty()
+    html_version = db.StringProperty()
+    dependencies = db.StringListProperty()
 
     def __init__(self, *args, **kwargs):
+        """New pages are stored under a key derived from their title, see
+        key_name_for()."""
+        if not args and kwargs.get('title') and not kwargs.get('_from_entity') and 'key' not in kwargs and 'key_name' not in kwargs:
+            kwargs['key_name'] = self.key_name_for(kwargs['title'])
         super(WikiContent, self).__init__(*args, **kwargs)
         self._parsed_page = None
+        self._parsed_body = None
+        # The body that the html property was rendered from.
+        self._html_body = self.body
 
     def get_author_nick(self):
         if self.author:
@@ -103,18 +303,23 @@ class WikiContent(db.Model):
         
         return 'anonymous'
 
+    def get_parsed_page(self):
+        """Returns the parsed body, parses it again only if it was changed."""
+        if self._parsed_page is None or self._parsed_body is not self.body:
+            self._parsed_page = self.parse_body(self.body or '')
+            self._parsed_body = self.body
+        return self._parsed_page
+
     def get_property(self, key, default=None):
         """Returns the value of a property."""
-        if self._parsed_page is None:
-            self._parsed_page = self.parse_body(self.body or '')
-        return self._parsed_page.get(key, default)
+        return self.get_parsed_page().get(key, default)
 
     def set_property(self, key, value):
         """Changes the value of a property."""
-        if self._parsed_page is None:
-            self._parsed_page = self.parse_body(self.body or '')
-        self._parsed_page[key] = value
-        self.body = self.format_body(self._parsed_page)
+        parsed = self.get_parsed_page()
+        parsed[key] = value
+        self.body = self.format_body(parsed)
+        self._parsed_body = self.body
 
         user = users.get_current_user()
         if user:
@@ -145,6 +350,40 @@ class WikiContent(db.Model):
             data = util.wikify_filter(self.body, display_title='')
         return data
 
+    def render_html(self, assume_saved=False):
+        """Renders the body and updates the html and dependencies properties."""
+        self.html = util.wikify_filter(self.body or '', page_name=self.title, assume_saved=assume_saved)
+        self.html_version = util.get_renderer_version()
+        self.dependencies = util.extract_dependencies(self.body or '', self.title)
+        self._html_body = self.body
+
+    def get_html(self):
+        """Returns the rendered body.  The stored HTML is used unless the body
+        was changed (previews, revisions) or the renderer version differs.
+        Stale HTML of a saved page is rendered again and stored."""
+        if self._html_body is not self.body:
+            return util.wikify_filter(self.body or '', page_name=self.title)
+        if self.html is None or self.html_version != util.get_renderer_version():
+            self.render_html()
+            if self.is_saved():
+                try:
+                    db.run_in_transaction(self._store_html)
+                except db.TransactionFailedError:
+                    logging.warning(u'Could not store rendered HTML of page "%s".' % self.title)
+        return self.html
+
+    def _store_html(self):
+        """Copies the rendered HTML to the stored page, unless the page was
+        changed since this instance was loaded: the instance may be stale
+        (request cache, memcache) and must not overwrite a newer save."""
+        stored = db.get(self.key())
+        if stored is None or stored.body != self.body or stored.updated != self.updated:
+            return
+        stored.html = self.html
+        stored.html_version = self.html_version
+        stored.dependencies = self.dependencies
+        db.Model.put(stored)
+
     def get_display_title(self):
         return self.get_property('display_title', self.title)
 
@@ -166,10 +405,72 @@ class WikiContent(db.Model):
 
     def put(self):
         """Adds the gaewiki:parent: labels transparently."""
+        state = self.prepare_put()
+        page, key = self.save(state)
+        titles, labels, purge = self.finish_put(page, state)
+        WikiLabelIndex.update(self.get_label_updates(state))
+        self.queue_flush(titles, labels, exclude=[key])
+        memcache.delete_multi(purge, namespace=cache.get_namespace())
+        search.queue_update([state['title'], self.title])
+        sitemap.queue_build([state['title'], self.title])
+        cache.note_change()
+        return key
+
+    @classmethod
+    def put_many(cls, pages):
+        """Saves pages with one batch put and flushes the pages that depend
+        on them together.  Pages that move to another key are saved one by
+        one."""
+        states = [page.prepare_put() for page in pages]
+        saved = []
+        batch = []
+        for page, state in zip(pages, states):
+            if page.needs_move(state):
+                saved.append(page.save(state)[0])
+            else:
+                saved.append(page)
+                batch.append(page)
+        db.put(batch)
+
+        titles, labels, purge = set(), set(), []
+        updates = {}
+        for page, saved_page, state in zip(pages, saved, states):
+            new_titles, new_labels, keys = page.finish_put(saved_page, state)
+            titles.update(new_titles)
+            labels.update(new_labels)
+            purge.extend(keys)
+            for label, (removed, added) in page.get_label_updates(state).items():
+                updates.setdefault(label, (set(), []))[0].update(removed)
+                updates[label][1].extend(added)
+        WikiLabelIndex.update(updates)
+        # Pages were rendered before the batch was stored, so the ones that
+        # depend on other pages of the batch must be rendered again.
+        changed = set(['link:' + title.replace('_', ' ') for title in titles] + ['label:' + label for label in labels])
+        exclude = [saved_page.key() for saved_page in saved if not changed.intersection(saved_page.dependencies or []).difference(['link:' + saved_page.title])]
+        cls.queue_flush(titles, labels, exclude=exclude)
+        memcache.delete_multi(purge, namespace=cache.get_namespace())
+        affected = [state['title'] for state in states] + [page.title for page in pages]
+        search.queue_update(affected)
+        sitemap.queue_build(affected)
+        cache.note_change()
+
+    def prepare_put(self):
+        """Updates the properties derived from the body.  Returns the previous
+        values, which save() and finish_put() need."""
+        state = {
+            'title': self.title,
+            'labels': list(self.labels or []),
+            'links': list(self.links or []),
+            'saved': self.is_saved(),
+        }
         if self.body is not None:
             options = util.parse_page(self.body)
             self.redirect = options.get('redirect')
             self.pread = options.get('public') == 'yes' and options.get('private') != 'yes'
+            self.private = options.get('private') == 'yes'
+            self.public = options.get('public') == 'yes'
+            self.readers = sorted(set(util.as_list(options.get('readers')) + util.as_list(options.get('editors'))))
+            self.locked = options.get('locked') == 'yes'
             self.labels = options.get('labels', [])
             if 'date' in options:
                 try:
@@ -183,9 +484,155 @@ class WikiContent(db.Model):
             self.__update_geopt()
 
         self.links = util.extract_links(self.body)
+        self.sort_title = self.get_sort_title(self.title)
+        self.sitemap_shard = sitemap.get_shard(self.title)
         self.add_implicit_labels()
-        db.Model.put(self)
+        self.render_html(assume_saved=True)
+        return state
+
+    def needs_move(self, state):
+        """Returns True if the page must be saved under a different key: it
+        was renamed or uses a legacy key."""
+        if self.is_saved():
+            return self.key() != self.key_for_title(self.title)
+        return state['title'] != self.title and self.key().name() == self.key_name_for(state['title'])
+
+    def save(self, state):
+        """Stores the page, returns the saved entity and its key.  A page that
+        needs to move is saved as a copy under the new key and the instance
+        is then bound to that copy, so that later puts and deletes use the
+        new key."""
+        if not self.needs_move(state):
+            return self, db.Model.put(self)
+        page = self.rekeyed()
+        key = db.put(page)
+        if self.is_saved():
+            db.delete(self.key())
+            logging.info(u'Moved page "%s" from key %s to %s' % (self.title, self.key(), key))
+        # db.Model keeps the key in its datastore entity and has no public
+        # way to change it.
+        self._entity = page._entity
+        return self, key
+
+    def finish_put(self, page, state):
+        """Updates caches after the page was saved as page (self or a copy).
+        Returns the titles and labels whose dependents must be flushed and
+        the memcache keys to purge."""
+        old_title = state['title']
+        if old_title != self.title:
+            cache.put('WikiContent', old_title.replace('_', ' '), None)
+        cache.put('WikiContent', self.title.replace('_', ' '), page)
         settings.check_and_flush(self)
+        util.flush_fragment(self.title)
+
+        # Pages that link here only change when this one appears or goes
+        # away, pages listing the labels change with every edit.
+        labels = set(state['labels'] + self.labels)
+        titles = []
+        if not state['saved'] or old_title != self.title:
+            titles = [old_title, self.title]
+
+        purge = self.get_cache_keys() + ['PagesFeed:' + label for label in labels]
+        purge += ['BackLinks:' + link.replace('_', ' ') for link in set(state['links']) ^ set(self.links)]
+        if old_title != self.title:
+            purge += ['Page:' + old_title, 'RawPage:' + old_title]
+        return titles, labels, purge
+
+    def get_label_entry(self):
+        """Returns what label lists show about the page: title, display
+        title, redirect and creation time."""
+        created = self.created and self.created.strftime('%Y-%m-%d %H:%M:%S') or ''
+        return [self.title, self.get_property('display_title'), self.redirect, created]
+
+    def get_label_updates(self, state):
+        """Returns the changes to the label indexes after a save: a dictionary
+        that maps labels to the titles to remove and the entries to add."""
+        updates = {}
+        for label in set(state['labels'] + self.labels):
+            entries = label in self.labels and [self.get_label_entry()] or []
+            updates[label] = (set([state['title'], self.title]), entries)
+        return updates
+
+    def delete(self):
+        db.Model.delete(self)
+        cache.put('WikiContent', self.title.replace('_', ' '), None)
+        WikiLabelIndex.update(dict([(label, (set([self.title]), [])) for label in self.labels]))
+        self.queue_flush([self.title], self.labels)
+        memcache.delete_multi(self.get_cache_keys(), namespace=cache.get_namespace())
+        search.queue_update([self.title])
+        sitemap.queue_build([self.title])
+        cache.note_change()
+
+    def get_cache_keys(self):
+        """Returns memcache keys of the things rendered from this page."""
+        keys = ['Page:' + self.title, 'RawPage:' + self.title, 'PageHistory:' + self.title, 'BackLinks:' + self.title]
+        return keys + ['PagesFeed:' + label for label in self.labels]
+
+    @classmethod
+    def queue_flush(cls, titles, labels, exclude=()):
+        """Queues a task that flushes the pages which depend on the titles or
+        labels (see flush_dependents), except the excluded keys."""
+        titles = sorted(set([t.replace('_', ' ') for t in titles]))
+        labels = sorted(set(labels))
+        if titles or labels:
+            data = json.dumps({'titles': titles, 'labels': labels, 'exclude': [str(k) for k in exclude]})
+            taskqueue.add(url='/w/cache/flush', params={'data': data})
+
+    @staticmethod
+    def get_dependent_queries(titles, labels):
+        """Returns (property, value) pairs that find the pages which link to
+        any of the titles or list any of the labels.  Pages saved before
+        dependencies were tracked are found by their links."""
+        queries = [('dependencies', 'link:' + t) for t in titles] + [('dependencies', 'label:' + l) for l in labels]
+        queries += [('links', t) for t in titles] + [('links', t.replace(' ', '_')) for t in titles if ' ' in t]
+        queries += [('links', 'List:' + l) for l in labels]
+        return queries
+
+    @classmethod
+    def flush_dependents(cls, titles, labels, exclude=(), position=0, cursor=None):
+        """Drops the stored and cached HTML of up to FLUSH_BATCH_SIZE pages
+        that depend on the titles or labels, so that they're rendered again
+        when viewed.  Walks get_dependent_queries() in order with cursors.
+        Returns the position and cursor to continue from, None when done."""
+        queries = cls.get_dependent_queries(titles, labels)
+        if position >= len(queries):
+            return None
+        name, value = queries[position]
+        query = cls.all(keys_only=True).filter(name + ' =', value)
+        if cursor:
+            query.with_cursor(cursor)
+        found = query.fetch(cls.FLUSH_BATCH_SIZE)
+        keys = [k for k in found if str(k) not in exclude]
+
+        flushed = []
+        options = db.create_transaction_options(xg=True)
+        for idx in range(0, len(keys), cls.FLUSH_TRANSACTION_SIZE):
+            flushed.extend(db.run_in_transaction_options(options, cls._clear_html, keys[idx:idx + cls.FLUSH_TRANSACTION_SIZE]))
+        memcache.delete_multi(['Page:' + t for t in flushed], namespace=cache.get_namespace())
+        for title in flushed:
+            util.flush_fragment(title)
+
+        if len(found) == cls.FLUSH_BATCH_SIZE:
+            return position, query.cursor()
+        if position + 1 < len(queries):
+            return position + 1, None
+        return None
+
+    @staticmethod
+    def _clear_html(keys):
+        """Clears the stored HTML of the pages, returns their titles."""
+        pages = [p for p in db.get(keys) if p is not None]
+        changed = [p for p in pages if p.html is not None]
+        for page in changed:
+            page.html = None
+        db.put(changed)
+        return [p.title for p in pages]
+
+    def rekeyed(self):
+        """Returns a copy of the page stored under the key derived from its
+        title."""
+        values = dict([(name, prop.get_value_for_datastore(self)) for name, prop in self.properties().items()])
+        return WikiContent(key_name=self.key_name_for(self.title), **values)
 
     def __update_geopt(self):
         """Updates the geopt property from the appropriate page property.
@@ -212,10 +659,22 @@ class WikiContent(db.Model):
         self.labels = labels
 
     def backup(self):
-        """Archives the current page revision."""
+        """Archives the current page revision.  The previous revision is
+        replaced with a delta against this one, unless it's a keyframe."""
         logging.debug(u'Backing up page "%s"' % self.title)
-        archive = WikiRevision(title=self.title, revision_body=self.body, author=self.author, created=self.updated)
-        archive.put()
+        previous = WikiRevision.gql('WHERE title = :1 ORDER BY created DESC', self.title).get()
+        revision = self.make_revision()
+        revision.number = (previous and previous.number or 0) + 1
+        revision.put()
+        if previous is not None and not previous.is_keyframe() and not previous.is_delta():
+            previous.set_delta(revision)
+            previous.put()
+
+    def make_revision(self, key_name=None):
+        """Returns an unsaved revision with the current page contents."""
+        revision = WikiRevision(key_name=key_name, title=self.title, author=WikiContent.author.get_value_for_datastore(self), created=self.updated)
+        revision.set_body(self.body or '')
+        return revision
 
     def update(self, body, author, delete):
         if self.is_saved():
@@ -238,6 +697,14 @@ class WikiContent(db.Model):
     def get_history(self, limit=100):
         return WikiRevision.gql('WHERE title = :1 ORDER BY created DESC', self.title).fetch(limit)
 
+    def get_history_page(self, cursor=None, limit=50):
+        """Lists revisions newest first with a projection query, so that only
+        created and author are loaded.  Returns the revisions and the cursor
+        of the next page, None if this is the last one."""
+        query = db.Query(WikiRevision, projection=('created', 'author'))
+        query.filter('title =', self.title).order('-created')
+        return fetch_page(query, cursor, limit)
+
     def get_backlinks(self):
         return self.find_backlinks_for(self.title)
 
@@ -246,14 +713,18 @@ class WikiContent(db.Model):
         return WikiContent.gql('WHERE links = :1', title).fetch(limit)
 
     def load_template(self, user, is_admin):
+        if self.title == settings.SETTINGS_PAGE_NAME:
+            self.body = settings.DEFAULT_SETTINGS
+            return
         template = '# PAGE_TITLE\n\n**PAGE_TITLE** is ...'
         template_names = ['gaewiki:anon page template']
         if user is not None:
             template_names.insert(0, 'gaewiki:user page template')
         if users.is_current_user_admin():
             template_names.insert(0, 'gaewiki:admin page template')
+        templates = self.get_by_titles(template_names)
         for template_name in template_names:
-            page = WikiContent.gql('WHERE title = :1', template_name).get()
+            page = templates.get(template_name)
             if page is not None:
                 logging.debug('Loaded template from %s' % template_name)
                 template = page.body.replace(template_name, 'PAGE_TITLE')
@@ -264,8 +735,19 @@ class WikiContent(db.Model):
 
     def is_locked(self):
         """Returns True if the page has the locked:yes property."""
+        if self.locked is not None:
+            return self.locked
         return self.get_property('locked') == 'yes'
 
+    def get_acl(self):
+        """Returns the private and public flags and the readers of the page.
+        Pages saved before these were stored have their body parsed."""
+        if self.private is not None:
+            return self.private, self.public, self.readers
+        options = self.get_parsed_page()
+        readers = util.as_list(options.get('readers')) + util.as_list(options.get('editors'))
+        return options.get('private') == 'yes', options.get('public') == 'yes', readers
+
     def get_redirected(self):
         """Returns the page that this one redirects to (if at all)."""
         if self.redirect:
@@ -274,50 +756,221 @@ class WikiContent(db.Model):
                 return page
         return self
 
+    @staticmethod
+    def key_name_for(title):
+        """Returns the key name for a page title.  Very long titles are hashed
+        to fit the key name length limit."""
+        title = title.replace('_', ' ')
+        if len(title.encode('utf-8')) > 400:
+            return 'page#' + hashlib.sha1(title.encode('utf-8')).hexdigest()
+        return u'page:' + title
+
+    @classmethod
+    def key_for_title(cls, title):
+        return db.Key.from_path('WikiContent', cls.key_name_for(title))
+
+    @classmethod
+    def use_legacy_lookups(cls):
+        """Returns True until all pages are moved to title-derived keys and
+        have sort titles and sitemap shards, which the /w/data/rekey task
+        does before setting title-keys: yes.  Until then listings use the
+        old queries, and the task is queued automatically."""
+        if settings.get('title-keys') == 'yes':
+            return False
+        cls.queue_rekey()
+        return True
+
+    @staticmethod
+    def queue_rekey():
+        """Queues /w/data/rekey once per instance, and once per REKEY_RETRY
+        seconds across instances, so that a chain that died is restarted."""
+        global _rekey_queued
+        if _rekey_queued:
+            return
+        _rekey_queued = True
+        if memcache.add(REKEY_QUEUED_KEY, True, time=REKEY_RETRY):
+            taskqueue.add(url='/w/data/rekey', params={})
+
     @classmethod
     def get_by_title(cls, title, default_body=None, create_if_none=True):
         """Finds and loads the page by its title, creates a new one if nothing
         could be found."""
         title = title.replace('_', ' ')
-        page = cls.gql('WHERE title = :1', title).get()
+        if cache.contains('WikiContent', title):
+            page = cache.get('WikiContent', title)
+        else:
+            page = db.get(cls.key_for_title(title))
+            if page is None and cls.use_legacy_lookups():
+                page = cls.gql('WHERE title = :1', title).get()
+            cache.put('WikiContent', title, page)
         if page is None and create_if_none:
             page = cls(title=title)
             if default_body is not None:
                 page.body = default_body
         return page
 
+    @classmethod
+    def get_by_titles(cls, titles):
+        """Loads many pages with a single batch get.  Returns a dictionary
+        that maps (normalized) titles to saved pages, missing pages are not
+        included."""
+        titles = list(set([t.replace('_', ' ') for t in titles]))
+        pages = dict([(t, cache.get('WikiContent', t)) for t in titles if cache.contains('WikiContent', t)])
+        unknown = [t for t in titles if t not in pages]
+        if unknown:
+            pages.update(zip(unknown, db.get([cls.key_for_title(t) for t in unknown])))
+            missing = [t for t in unknown if pages[t] is None]
+            if missing and cls.use_legacy_lookups():
+                for idx in range(0, len(missing), MAX_IN_VALUES):
+                    for page in cls.gql('WHERE title IN :1', missing[idx:idx + MAX_IN_VALUES]):
+                        pages[page.title] = page
+            for title in unknown:
+                cache.put('WikiContent', title, pages[title])
+        return dict([(t, p) for t, p in pages.items() if p is not None])
+
+    @classmethod
+    def find_existing_titles(cls, titles):
+        """Returns the set of titles which have saved pages."""
+        return set(cls.get_by_titles(titles).keys())
+
+    @classmethod
+    def rekey_pages(cls, pages):
+        """Moves pages stored under legacy keys to title-derived keys, and
+        fills in sort titles, sitemap shards and access properties of pages
+        saved before they existed.  Returns the number of moved pages."""
+        stale = [p for p in pages if p.sort_title != cls.get_sort_title(p.title) or p.sitemap_shard != sitemap.get_shard(p.title) or p.private is None]
+        for page in stale:
+            page.sort_title = cls.get_sort_title(page.title)
+            page.sitemap_shard = sitemap.get_shard(page.title)
+            page.private, page.public, page.readers = page.get_acl()
+            page.locked = page.is_locked()
+        moved = [p for p in pages if p.key() != cls.key_for_title(p.title)]
+        if moved:
+            db.put([p.rekeyed() for p in moved])
+            db.delete([p.key() for p in moved])
+        db.put([p for p in stale if p not in moved])
+        return len(moved)
+
+    @classmethod
+    def import_records(cls, records, merge=False):
+        """Imports exported pages, dictionaries with title, author (email) and
+        body.  Users and existing pages are loaded with batch lookups, pages
+        and revisions are written with batch puts.  With merge, existing
+        pages are left alone.  Importing the same records again changes
+        nothing: pages that already have the body are skipped and archived
+        revisions have keys derived from the page version, so a retried task
+        doesn't add duplicates.  Returns the number of imported pages."""
+        records = dict([(r['title'].replace('_', ' '), r) for r in records])
+        existing = cls.get_by_titles(records.keys())
+        authors = WikiUser.get_or_create_many([users.User(r['author']) for r in records.values() if r.get('author')])
+
+        pages = []
+        revisions = []
+        now = datetime.datetime.now()
+        for title, record in sorted(records.items()):
+            page = existing.get(title)
+            if page is None:
+                page = cls(title=title)
+            elif merge or page.body == record['body']:
+                continue
+            else:
+                revisions.append(page.make_revision(key_name=WikiRevision.key_name_for(page)))
+            page.body = record['body']
+            page.author = authors.get(record.get('author'))
+            page.updated = now
+            pages.append(page)
+
+        db.put(revisions)
+        cls.put_many(pages)
+        return len(pages)
+
     @classmethod
     def get_by_label(cls, label):
         """Returns a list of pages that have the specified label."""
         return cls.gql('WHERE labels = :1', label).fetch(100)
 
     @classmethod
-    def get_publicly_readable(cls):
-        if settings.get('open-reading') == 'yes':
-            pages = cls.all()
+    def get_sitemap_query(cls, shard):
+        """Returns a query for the publicly readable pages of a sitemap shard,
+        which loads only title and updated.  Until pages have shards (see
+        use_legacy_lookups) it returns all publicly readable pages, which the
+        caller filters by shard."""
+        if cls.use_legacy_lookups():
+            query = cls.all()
         else:
-            pages = cls.gql('WHERE pread = :1', True).fetch(1000)
-        return sorted(pages, key=lambda p: p.title.lower())
+            query = db.Query(cls, projection=('title', 'updated')).filter('sitemap_shard =', shard)
+        if settings.get('open-reading') != 'yes':
+            query.filter('pread =', True)
+        return query
+
+    @staticmethod
+    def get_sort_title(title):
+        """Case-insensitive, pages without a namespace come first."""
+        if ':' in title:
+            return title.lower()
+        return u':' + title.lower()
 
     @classmethod
     def get_all(cls):
-        return sorted(cls.all().order('title').fetch(1000), key=lambda p: p.title.lower() if ':' in p.title else ':' + p.title.lower())
+        if cls.use_legacy_lookups():
+            return sorted(cls.all().order('title').fetch(1000), key=lambda p: cls.get_sort_title(p.title))
+        return cls.all().order('sort_title').fetch(1000)
+
+    @classmethod
+    def get_index_page(cls, cursor=None, limit=200):
+        """Lists pages by sort title, only title and redirect are loaded.
+        Until pages have sort titles, whole pages are listed by title.
+        Returns the pages and the cursor of the next page."""
+        if cls.use_legacy_lookups():
+            return fetch_page(cls.all().order('title'), cursor, limit)
+        query = db.Query(cls, projection=('title', 'redirect')).order('sort_title')
+        return fetch_page(query, cursor, limit)
+
+    @classmethod
+    def get_label_entries(cls, label, newest_first=False):
+        """Returns label entries (see get_label_entry) of all pages with the
+        label, by sort title or creation date."""
+        index = cache.get('WikiLabelIndex', label)
+        if index is None:
+            index = cache.put('WikiLabelIndex', label, WikiLabelIndex.get_by_label(label))
+        entries = index.get_entries()
+        if newest_first:
+            entries.sort(key=lambda e: e[3], reverse=True)
+        return entries
 
     @classmethod
-    def get_recently_added(cls, limit=100):
-        return cls.all().order('-created').fetch(limit)
+    def get_label_page(cls, label, cursor=None, limit=100, newest_first=False):
+        """Lists pages with the label by sort title or creation date.  Returns
+        the pages and the cursor of the next page.  Until pages have sort
+        titles, each page of results is sorted by title in memory."""
+        if newest_first:
+            return fetch_page(cls.all().filter('labels =', label).order('-created'), cursor, limit)
+        if cls.use_legacy_lookups():
+            pages, cursor = fetch_page(cls.all().filter('labels =', label), cursor, limit)
+            return sorted(pages, key=lambda p: cls.get_sort_title(p.title)), cursor
+        return fetch_page(cls.all().filter('labels =', label).order('sort_title'), cursor, limit)
 
     @classmethod
-    def get_recent_by_label(cls, label, limit=100):
-        return cls.gql('WHERE labels = :1 ORDER BY created DESC', label).fetch(limit)
+    def get_recently_added(cls, cursor=None, limit=50):
+        return fetch_page(cls.all().order('-created'), cursor, limit)
 
     @classmethod
-    def get_changes(cls):
+    def get_recent_by_label(cls, label, cursor=None, limit=50):
+        return fetch_page(cls.all().filter('labels =', label).order('-created'), cursor, limit)
+
+    @classmethod
+    def get_changes(cls, cursor=None, limit=50):
+        """Lists pages by modification date, only the properties shown in the
+        list are loaded.  Returns the pages and the cursor of the next
+        page."""
         if settings.get('open-reading') in ('yes', 'login'):
-            pages = cls.all().order('-updated').fetch(20)
-        else:
-            pages = cls.gql('WHERE pread = :1 ORDER BY updated DESC', True).fetch(20)
-        return pages
+            query = db.Query(cls, projection=('title', 'pread', 'created', 'updated', 'author')).order('-updated')
+            return fetch_page(query, cursor, limit)
+        query = db.Query(cls, projection=('title', 'created', 'updated', 'author')).filter('pread =', True).order('-updated')
+        pages, cursor = fetch_page(query, cursor, limit)
+        for page in pages:
+            page.pread = True
+        return pages, cursor
 
     @classmethod
     def get_error_page(cls, error_code, default_body=None):
@@ -325,21 +978,39 @@ class WikiContent(db.Model):
 
     @staticmethod
     def parse_body(page_content):
-        options = {}
-        parts = re.split('[\r\n]+---[\r\n]+', page_content, 1)
-        if len(parts) == 2:
-            for line in re.split('[\r\n]+', parts[0]):
-                if not line.startswith('#'):
-                    kv = line.split(':', 1)
-                    if len(kv) == 2:
-                        k = kv[0].strip()
-                        v = kv[1].strip()
-                        if k.endswith('s'):
-                            v = re.split(',\s*', v)
-                        options[k] = v
-        options['text'] = parts[-1]
+        """Returns the header properties and the text of a page.  Results
+        are kept by body hash, each call returns a copy that the caller may
+        change."""
+        if isinstance(page_content, unicode):
+            key = (unicode, hashlib.sha1(page_content.encode('utf-8')).digest())
+        else:
+            key = (str, hashlib.sha1(page_content).digest())
+        parsed = parsed_bodies.get(key)
+        if parsed is None:
+            parsed = parsed_bodies.put(key, WikiContent.parse_header(page_content))
+        options = dict([(k, isinstance(v, list) and list(v) or v) for k, v in parsed[0].items()])
+        options['text'] = page_content[parsed[1]:]
         return options
 
+    @staticmethod
+    def parse_header(page_content):
+        """Returns the header properties and the offset of the text."""
+        options = {}
+        match = HEADER_SEPARATOR.search(page_content)
+        if match is None:
+            return options, 0
+        for line in LINE_BREAKS.split(page_content[:match.start()]):
+            if line.startswith('#'):
+                continue
+            k, sep, v = line.partition(':')
+            if sep:
+                k = k.strip()
+                v = v.strip()
+                if k.endswith('s'):
+                    v = LIST_SEPARATOR.split(v)
+                options[k] = v
+        return options, match.end()
+
     @staticmethod
     def format_body(parsed):
         """Returns the text representation of a parsed body dictionary."""
@@ -370,15 +1041,281 @@ class WikiRevision(db.Model):
     """
     title = db.StringProperty()
     wiki_page = db.ReferenceProperty(WikiContent)
-    revision_body = db.TextProperty(required=True)
+    revision_body = db.TextProperty()
     author = db.ReferenceProperty(WikiUser)
     created = db.DateTimeProperty(auto_now_add=True)
     pread = db.BooleanProperty()
+    # Packed body: the full text, or a delta against the base revision (the
+    # next newer one), compressed unless disabled with compress-revisions.
+    # Older revisions only have revision_body.
+    revision_data = db.BlobProperty()
+    encoding = db.StringProperty()
+    base = db.SelfReferenceProperty(collection_name='deltas')
+    number = db.IntegerProperty()
+
+    # Every this many revisions of a page one is kept in full, which limits
+    # the number of deltas applied to get a revision.
+    KEYFRAME_INTERVAL = 20
 
     @classmethod
     def get_by_key(cls, key):
         return db.Model.get(db.Key(key))
 
+    @staticmethod
+    def key_name_for(page):
+        """Returns the key name for an archived version of the page, the same
+        every time that version is archived."""
+        return 'rev:%s:%s' % (hashlib.sha1(page.title.encode('utf-8')).hexdigest(), page.updated.strftime('%Y%m%d%H%M%S%f'))
+
+    def is_delta(self):
+        return self.encoding is not None and self.encoding.startswith('delta')
+
+    def is_keyframe(self):
+        return self.number is not None and self.number % self.KEYFRAME_INTERVAL == 0
+
+    def set_body(self, body):
+        self.pack(body, 'full')
+        self.base = None
+
+    def set_delta(self, base):
+        """Stores the body as a delta against the (newer) base revision, if
+        that's shorter."""
+        body = self.get_body()
+        delta = util.make_delta(base.get_body(), body)
+        if len(delta) < len(body.encode('utf-8')):
+            self.pack(delta, 'delta')
+            self.base = base
+
+    def pack(self, data, encoding):
+        data = data.encode('utf-8')
+        if settings.get('compress-revisions', 'yes') == 'yes':
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                encoding += '+zlib'
+        self.revision_data = db.Blob(data)
+        self.encoding = encoding
+        self.revision_body = None
+
+    def unpack(self):
+        if self.encoding is None:
+            return self.revision_body
+        data = self.revision_data
+        if self.encoding.endswith('+zlib'):
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+
+    def get_body(self):
+        """Returns the text of the revision.  Deltas are applied starting
+        from the nearest full revision, newer revisions up to a keyframe are
+        loaded with one query."""
+        chain = [self]
+        if self.is_delta():
+            newer = WikiRevision.gql('WHERE title = :1 AND created > :2 ORDER BY created', self.title, self.created).fetch(self.KEYFRAME_INTERVAL)
+            newer = dict([(r.key(), r) for r in newer])
+            while chain[-1].is_delta():
+                key = WikiRevision.base.get_value_for_datastore(chain[-1])
+                chain.append(newer.get(key) or WikiRevision.get(key))
+        body = chain.pop().unpack()
+        while chain:
+            body = util.apply_delta(body, chain.pop().unpack())
+        return body
+
+    @classmethod
+    def get_bodies(cls, revisions):
+        """Returns the texts of revisions ordered by title, newest first.  A
+        delta's base is the next newer revision, so the bodies are rebuilt
+        along each chain in memory; only a delta whose base isn't in the
+        list is loaded with get_body()."""
+        bodies, newer = [], None
+        for revision in revisions:
+            if not revision.is_delta():
+                body = revision.unpack()
+            elif newer is not None and cls.base.get_value_for_datastore(revision) == newer.key():
+                body = util.apply_delta(bodies[-1], revision.unpack())
+            else:
+                body = revision.get_body()
+            newer = revision
+            bodies.append(body)
+        return bodies
+
+class WikiImport(db.Model):
+    """A data import, split into WikiImportChunk children which are
+    processed by a chain of tasks."""
+    created = db.DateTimeProperty(auto_now_add=True)
+    merge = db.BooleanProperty(default=False)
+    chunks = db.IntegerProperty(default=0)
+    done = db.IntegerProperty(default=0)
+    pages = db.IntegerProperty(default=0)
+
+    def is_finished(self):
+        return self.done >= self.chunks
+
+    @classmethod
+    def finish_chunk(cls, key, number, count):
+        """Marks an imported chunk done and deletes it.  Run in a
+        transaction."""
+        chunk = WikiImportChunk.get_by_key_name(WikiImportChunk.key_name_for(number), parent=key)
+        if chunk is None:
+            return
+        job = db.get(key)
+        job.done = max(job.done, number + 1)
+        job.pages += count
+        db.put(job)
+        chunk.delete()
+
+
+class WikiImportChunk(db.Model):
+    """Records imported by one task, JSON encoded.  Deleted once imported,
+    see WikiImport.finish_chunk()."""
+    records = db.TextProperty()
+
+    @staticmethod
+    def key_name_for(number):
+        return 'chunk-%06u' % number
+
+
+class WikiSitemap(db.Model):
+    """A gzipped sitemap shard, see the sitemap module."""
+    data = db.BlobProperty()
+    count = db.IntegerProperty(default=0)
+    updated = db.DateTimeProperty(auto_now=True)
+    # The base URL of the links.
+    base = db.StringProperty()
+
+    @staticmethod
+    def key_name_for(shard):
+        return 'shard-%u' % shard
+
+
+class WikiTitleIndex(db.Model):
+    """Titles of all pages sorted case-insensitively, one per line, zlib
+    compressed.  There's one, keyed 'titles'."""
+    titles = db.BlobProperty()
+
+    def get_titles(self):
+        if not self.titles:
+            return []
+        return zlib.decompress(self.titles).decode('utf-8').split(u'\n')
+
+    def set_titles(self, titles):
+        titles = sorted(set(titles), key=lambda t: (t.lower(), t))
+        self.titles = db.Blob(zlib.compress(u'\n'.join(titles).encode('utf-8')))
+
+
+class WikiLabelIndex(db.Model):
+    """Label entries (see WikiContent.get_label_entry) of all pages with a
+    label, sorted by sort title, JSON encoded and zlib compressed.  Built
+    when the label is first listed, updated when pages are saved.
+
+    While an index is being built it's stored with building set, and saves
+    record their changes in pending instead of entries; the build applies
+    them to its query results, so saves made during the build aren't lost.
+    Deleting the indexes (see drop_all) makes them rebuild."""
+    entries = db.BlobProperty()
+    building = db.BooleanProperty(default=False)
+    pending = db.TextProperty()
+
+    BATCH_SIZE = 500
+
+    def get_entries(self):
+        if not self.entries:
+            return []
+        return json.loads(zlib.decompress(self.entries))
+
+    def set_entries(self, entries):
+        entries = sorted(entries, key=lambda e: (WikiContent.get_sort_title(e[0]), e[0]))
+        self.entries = db.Blob(zlib.compress(json.dumps(entries, separators=(',', ':'))))
+
+    @classmethod
+    def get_by_label(cls, label):
+        """Returns the index of a label, builds it with a query if it doesn't
+        exist yet or a previous build didn't finish."""
+        key_name = WikiContent.key_name_for(label)
+        index = cls.get_by_key_name(key_name)
+        if index is not None and not index.building:
+            return index
+        db.run_in_transaction(cls._start_build, key_name)
+        entries = []
+        for pages in fetch_batches(WikiContent.all().filter('labels =', label), cls.BATCH_SIZE):
+            entries.extend([p.get_label_entry() for p in pages])
+        return db.run_in_transaction(cls._finish_build, key_name, entries)
+
+    @classmethod
+    def _start_build(cls, key_name):
+        if cls.get_by_key_name(key_name) is None:
+            cls(key_name=key_name, building=True).put()
+
+    @classmethod
+    def _finish_build(cls, key_name, entries):
+        """Stores the built entries with the changes saved during the build
+        applied, unless another build finished first."""
+        index = cls.get_by_key_name(key_name)
+        if index is not None and not index.building:
+            return index
+        index = index or cls(key_name=key_name)
+        for removed, added in json.loads(index.pending or '[]'):
+            entries = [e for e in entries if e[0] not in removed] + added
+        index.set_entries(entries)
+        index.building = False
+        index.pending = None
+        index.put()
+        return index
+
+    @classmethod
+    def drop_all(cls):
+        """Deletes all indexes, they're rebuilt when listed next."""
+        for keys in fetch_batches(cls.all(keys_only=True), cls.BATCH_SIZE):
+            db.delete(keys)
+
+    @classmethod
+    def update(cls, updates):
+        """Applies changes (label to titles to remove and entries to add),
+        one transaction per label, after the pages were saved.  Indexes that
+        don't exist yet are left alone, they're built when first needed."""
+        for label, (removed, added) in updates.items():
+            cache.forget('WikiLabelIndex', label)
+            db.run_in_transaction(cls._update, WikiContent.key_name_for(label), removed, added)
+
+    @classmethod
+    def _update(cls, key_name, removed, added):
+        index = cls.get_by_key_name(key_name)
+        if index is None:
+            return
+        if index.building:
+            pending = json.loads(index.pending or '[]')
+            pending.append([sorted(removed), added])
+            index.pending = json.dumps(pending)
+            index.put()
+            return
+        entries = index.get_entries()
+        index.set_entries([e for e in entries if e[0] not in removed] + added)
+        if index.get_entries() != entries:
+            index.put()
+
+
+class WikiSearchDocument(db.Model):
+    """Terms of a page as last indexed by the search module, JSON encoded
+    (term to frequency).  Uses the key name of the page."""
+    title = db.StringProperty()
+    terms = db.TextProperty()
+    length = db.IntegerProperty(default=0)
+
+
+class WikiSearchShard(db.Model):
+    """A part of the posting list of a term, keyed by the term and the shard
+    number.  Maps page titles to [term frequency, page length], JSON
+    encoded.  Shards of the empty term count the indexed pages and their
+    total length instead."""
+    postings = db.TextProperty()
+    documents = db.IntegerProperty(default=0)
+    length = db.IntegerProperty(default=0)
+
+    @staticmethod
+    def key_name_for(term, shard):
+        return u'%s:%u' % (term, shard)
+
+
 class EmptyPage(WikiContent):
   def __init__(self, author=None):
     super(EmptyPage, self).__init__(title='Default')
@@ -0,0 +1,302 @@
+# encoding=utf-8
+
+"""Full-text search.  Pages are split into stemmed terms; the posting list
+of every term is split into SHARDS entities by page title, so that a page
+update only touches one shard per term and a query loads all shards of all
+its terms with one batch get.  Results are ranked with BM25.
+
+The index is updated by tasks queued when pages are saved or deleted, and
+can be built from scratch from an export with build_index().
+
+The same tasks maintain a sorted list of all titles, which serves prefix
+lookups from instance memory."""
+
+import bisect
+import cgi
+import json
+import logging
+import math
+import re
+import zlib
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+import access
+import cache
+import model
+
+
+SHARDS = 8
+
+# Title words count as this many occurrences.
+TITLE_WEIGHT = 3
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+# Shards changed in one cross-group transaction (the limit is 25 groups).
+TRANSACTION_SIZE = 20
+
+MAX_QUERY_TERMS = 10
+
+# Bumped when the title index changes.
+TITLES_VERSION_KEY = 'gaewiki:titles'
+
+# The title index kept in instance memory: (version, lowercase titles,
+# titles), replaced as a whole.
+title_index = (None, [], [])
+
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+STOP_WORDS = frozenset(u"""a an and are as at be but by for from has have i
+    if in into is it its of on or that the their there these this to was were
+    will with""".split())
+
+
+def stem(word):
+    """A light English stemmer: strips plural endings.  Words never contain
+    apostrophes (see WORD_PATTERN), so a possessive "s" is left as a
+    separate one-letter word, which tokenize() drops."""
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Returns the stemmed terms of the text, in order."""
+    words = WORD_PATTERN.findall(text.lower())
+    return [stem(w) for w in words if len(w) > 1 and w not in STOP_WORDS]
+
+
+def get_terms(title, body):
+    """Returns a dictionary of term frequencies and the length of a page."""
+    terms = {}
+    text = model.WikiContent.parse_body(body or '').get('text', '')
+    for term in tokenize(text):
+        terms[term] = terms.get(term, 0) + 1
+    for term in tokenize(title):
+        terms[term] = terms.get(term, 0) + TITLE_WEIGHT
+    return terms, sum(terms.values())
+
+
+def get_shard(title):
+    return zlib.crc32(title.encode('utf-8')) % SHARDS
+
+
+def queue_update(titles):
+    """Queues a task that updates the index for the pages."""
+    titles = sorted(set([t.replace('_', ' ') for t in titles]))
+    if titles:
+        taskqueue.add(url='/w/search/index', params={'title': titles})
+
+
+def update_index(titles):
+    """Brings the index up to date with the pages, which may have been
+    changed, added or deleted.  Posting lists are updated first, then the
+    stored terms of each page and the statistics, so a retried task does
+    not count a page twice."""
+    titles = list(set([t.replace('_', ' ') for t in titles]))
+    pages = model.WikiContent.get_by_titles(titles)
+    documents = model.WikiSearchDocument.get_by_key_name([model.WikiContent.key_name_for(t) for t in titles])
+
+    changes = {}
+    updated = []
+    for title, document in zip(titles, documents):
+        page = pages.get(title)
+        terms, length = {}, 0
+        if page is not None:
+            terms, length = get_terms(page.title, page.body)
+        old_terms = document and json.loads(document.terms) or {}
+        if old_terms == terms and (document is None or document.length == length):
+            continue
+        shard = get_shard(title)
+        for term in set(old_terms) - set(terms):
+            changes.setdefault(model.WikiSearchShard.key_name_for(term, shard), {})[title] = None
+        for term, count in terms.items():
+            changes.setdefault(model.WikiSearchShard.key_name_for(term, shard), {})[title] = [count, length]
+        updated.append((title, terms, length))
+
+    key_names = sorted(changes.keys())
+    options = db.create_transaction_options(xg=True)
+    for idx in range(0, len(key_names), TRANSACTION_SIZE):
+        batch = dict([(k, changes[k]) for k in key_names[idx:idx + TRANSACTION_SIZE]])
+        db.run_in_transaction_options(options, _update_postings, batch)
+    for title, terms, length in updated:
+        db.run_in_transaction_options(options, _update_document, title, terms, length)
+    logging.info(u'Indexed %u pages, %u posting lists changed.' % (len(updated), len(key_names)))
+
+    if db.run_in_transaction(_update_titles, pages.keys(), [t for t in titles if t not in pages]):
+        cache.bump_counter(TITLES_VERSION_KEY)
+
+
+def _update_postings(changes):
+    shards = model.WikiSearchShard.get_by_key_name(changes.keys())
+    put, delete = [], []
+    for key_name, shard in zip(changes.keys(), shards):
+        if shard is None:
+            shard = model.WikiSearchShard(key_name=key_name)
+        postings = json.loads(shard.postings or '{}')
+        for title, value in changes[key_name].items():
+            if value is None:
+                postings.pop(title, None)
+            else:
+                postings[title] = value
+        if postings:
+            shard.postings = json.dumps(postings, separators=(',', ':'))
+            put.append(shard)
+        elif shard.is_saved():
+            delete.append(shard)
+    db.put(put)
+    db.delete(delete)
+
+
+def _update_document(title, terms, length):
+    key_name = model.WikiContent.key_name_for(title)
+    document = model.WikiSearchDocument.get_by_key_name(key_name)
+    stats_key = model.WikiSearchShard.key_name_for('', get_shard(title))
+    stats = model.WikiSearchShard.get_by_key_name(stats_key) or model.WikiSearchShard(key_name=stats_key)
+    if document is not None:
+        stats.documents -= 1
+        stats.length -= document.length
+    if terms:
+        stats.documents += 1
+        stats.length += length
+        db.put([stats, model.WikiSearchDocument(key_name=key_name, title=title, terms=json.dumps(terms), length=length)])
+    else:
+        stats.put()
+        if document is not None:
+            document.delete()
+
+
+def _update_titles(added, removed):
+    """Adds and removes titles from the title index.  Returns True if it
+    changed."""
+    index = model.WikiTitleIndex.get_by_key_name('titles') or model.WikiTitleIndex(key_name='titles')
+    titles = set(index.get_titles())
+    changed = titles.union(added).difference(removed)
+    if changed == titles:
+        return False
+    index.set_titles(changed)
+    index.put()
+    return True
+
+
+def complete(prefix, limit=20):
+    """Returns up to limit titles that start with the prefix, ignoring case;
+    underscores match spaces."""
+    global title_index
+    version = cache.get_counter(TITLES_VERSION_KEY)
+    if title_index[0] != version:
+        index = model.WikiTitleIndex.get_by_key_name('titles')
+        titles = index and index.get_titles() or []
+        title_index = (version, [t.lower() for t in titles], titles)
+    version, keys, titles = title_index
+
+    prefix = prefix.replace('_', ' ').lower()
+    result = []
+    idx = bisect.bisect_left(keys, prefix)
+    while idx < len(keys) and len(result) < limit and keys[idx].startswith(prefix):
+        result.append(titles[idx])
+        idx += 1
+    return result
+
+
+def build_index(pages):
+    """Builds the whole index in memory from (title, body) pairs, for example
+    the pages of an NDJSON export.  Returns the entities to store, which
+    replace the index; existing entities that are not returned must be
+    deleted beforehand."""
+    postings = {}
+    stats = {}
+    entities = []
+    titles = []
+    for title, body in pages:
+        title = title.replace('_', ' ')
+        titles.append(title)
+        terms, length = get_terms(title, body)
+        if not terms:
+            continue
+        shard = get_shard(title)
+        for term, count in terms.items():
+            postings.setdefault(model.WikiSearchShard.key_name_for(term, shard), {})[title] = [count, length]
+        counts = stats.setdefault(shard, [0, 0])
+        counts[0] += 1
+        counts[1] += length
+        entities.append(model.WikiSearchDocument(key_name=model.WikiContent.key_name_for(title), title=title, terms=json.dumps(terms), length=length))
+    for key_name, values in postings.items():
+        entities.append(model.WikiSearchShard(key_name=key_name, postings=json.dumps(values, separators=(',', ':'))))
+    for shard, (documents, length) in stats.items():
+        entities.append(model.WikiSearchShard(key_name=model.WikiSearchShard.key_name_for('', shard), documents=documents, length=length))
+    index = model.WikiTitleIndex(key_name='titles')
+    index.set_titles(titles)
+    entities.append(index)
+    return entities
+
+
+def search(query, user=None, is_admin=False, limit=20):
+    """Returns up to limit (page, snippet) pairs for pages that match the
+    query and the user can read, best matches first."""
+    terms = sorted(set(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+
+    key_names = [model.WikiSearchShard.key_name_for(term, shard) for term in terms + [''] for shard in range(SHARDS)]
+    shards = model.WikiSearchShard.get_by_key_name(key_names)
+    stats = [s for s in shards[-SHARDS:] if s is not None]
+    documents = sum([s.documents for s in stats])
+    if documents <= 0:
+        return []
+    average = float(sum([s.length for s in stats])) / documents
+
+    scores = {}
+    for idx, term in enumerate(terms):
+        postings = {}
+        for shard in shards[idx * SHARDS:(idx + 1) * SHARDS]:
+            if shard is not None:
+                postings.update(json.loads(shard.postings))
+        idf = math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+        for title, (count, length) in postings.items():
+            scores[title] = scores.get(title, 0) + idf * count * (K1 + 1) / (count + K1 * (1 - B + B * length / average))
+
+    results = []
+    ranked = sorted(scores.keys(), key=lambda t: (-scores[t], t))
+    for idx in range(0, len(ranked), limit):
+        batch = ranked[idx:idx + limit]
+        pages = model.WikiContent.get_by_titles(batch)
+        readable = access.filter_readable([pages[t] for t in batch if t in pages], user, is_admin)
+        for page in readable:
+            results.append((page, get_snippet(page.body, terms)))
+            if len(results) == limit:
+                return results
+    return results
+
+
+def get_snippet(body, terms, before=60, after=140):
+    """Returns HTML with the part of the page text around the first match,
+    matching words are in bold."""
+    text = model.WikiContent.parse_body(body or '').get('text', '')
+    terms = set(terms)
+    matches = [m for m in WORD_PATTERN.finditer(text) if stem(m.group(0).lower()) in terms]
+    start = matches and max(0, matches[0].start() - before) or 0
+    end = start + before + after
+    parts = []
+    last = start
+    for match in matches:
+        if match.start() < start:
+            continue
+        if match.end() > end:
+            break
+        parts.append(cgi.escape(text[last:match.start()]))
+        parts.append(u'<b>%s</b>' % cgi.escape(match.group(0)))
+        last = match.end()
+    parts.append(cgi.escape(text[last:end]))
+    snippet = u''.join(parts).strip()
+    if start > 0:
+        snippet = u'…' + snippet
+    if end < len(text):
+        snippet += u'…'
+    return snippet
@@ -1,13 +1,20 @@
 # encoding=utf-8
 
+import hashlib
+
+import cache
 import model
 import util
 
 from google.appengine.api import memcache
+from google.appengine.ext import db
 
 
 SETTINGS_PAGE_NAME = 'gaewiki:settings'
 
+# Bumped whenever the settings page changes, checked once per request.
+VERSION_KEY = 'gaewiki:settings-version'
+
 DEFAULT_SETTINGS = """wiki_title: My Wiki
 start_page: Welcome
 admin_email: nobody@example.com
@@ -19,6 +26,7 @@ editors: user1@example.com, user2@example.com
 interwiki-google: http://www.google.ru/search?q=%s
 interwiki-wp: http://en.wikipedia.org/wiki/Special:Search?search=%s
 timezone: UTC
+title-keys: yes
 ---
 # gaewiki:settings
 
@@ -26,30 +34,62 @@ Edit me."""
 
 
 def get_host_page():
-    """Returns the page that hosts the settings."""
-    page = model.WikiContent.gql('WHERE title = :1', SETTINGS_PAGE_NAME).get()
+    """Returns the page that hosts the settings.  If there's none, returns an
+    unsaved page with the default settings: saving it here would render it,
+    which needs the settings."""
+    page = db.get(model.WikiContent.key_for_title(SETTINGS_PAGE_NAME))
+    if page is None:
+        page = model.WikiContent.gql('WHERE title = :1', SETTINGS_PAGE_NAME).get()
     if page is None:
         page = model.WikiContent(title=SETTINGS_PAGE_NAME, body=DEFAULT_SETTINGS)
-        page.put()
     return page
 
 
+# Parsed settings kept in instance memory, and the version they belong to.
+settings = None
+settings_version = None
+settings_fingerprint = None
+
+
+def get_version():
+    """Returns the current settings version, memcache is only asked once per
+    request."""
+    return cache.get_counter(VERSION_KEY)
+
+
 def get_all():
-    settings = memcache.get('gaewiki:settings')
-    if settings is None:
-        settings = util.parse_page(get_host_page().body)
-        memcache.set('gaewiki:settings', settings)
+    global settings, settings_version, settings_fingerprint
+    version = get_version()
+    if settings is None or settings_version != version:
+        cached = memcache.get('gaewiki:settings')
+        if cached is not None and cached[0] == version:
+            loaded = cached[1]
+        else:
+            loaded = util.parse_page(get_host_page().body)
+            memcache.set('gaewiki:settings', (version, loaded))
+        settings, settings_version = loaded, version
+        settings_fingerprint = hashlib.md5(repr(sorted(loaded.items()))).hexdigest()[:8]
     return settings
 
 
+def get_fingerprint():
+    """Returns a short hash of the current settings, which unlike the version
+    does not change when memcache is flushed."""
+    get_all()
+    return settings_fingerprint
+
+
 def get(key, default_value=None):
     return get_all().get(key, default_value)
 
 
 def check_and_flush(page):
     """Empties settings cache if the host page is updated."""
+    global settings
     if page.title == SETTINGS_PAGE_NAME:
+        cache.bump_counter(VERSION_KEY)
         memcache.delete('gaewiki:settings')
+        settings = None
 
 
 def change(upd):
@@ -0,0 +1,82 @@
+# encoding=utf-8
+
+"""Sitemaps.  Pages are split into SHARDS sitemaps by title hash (stored in
+WikiContent.sitemap_shard), each one kept gzipped in a WikiSitemap entity
+and rebuilt by a task when a page in it changes.  /sitemap.xml is an index
+of the shards.
+
+Tasks don't know the public host name, so shards remember the base URL
+they were built with; it's taken from requests for /sitemap.xml, which
+rebuild the shards if it changed."""
+
+import gzip
+import logging
+import StringIO
+import time
+import zlib
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+import model
+import settings
+
+
+# Shards hold up to 50k URLs each.
+SHARDS = 16
+MAX_URLS = 50000
+
+BATCH_SIZE = 1000
+
+# Changes within this many seconds are handled by one rebuild.
+DELAY = 60
+
+
+def get_shard(title):
+    return zlib.crc32(title.replace('_', ' ').encode('utf-8')) % SHARDS
+
+
+def queue_build(titles=None, base=None):
+    """Queues rebuilds of the shards that contain the pages, of all shards
+    if titles is None or the settings changed (they control which pages
+    are public).  Shards keep their base URL unless one is given."""
+    if titles is None or settings.SETTINGS_PAGE_NAME in titles:
+        shards = range(SHARDS)
+    else:
+        shards = set([get_shard(t) for t in titles])
+    bucket = int(time.time() / DELAY)
+    params = base and {'base': base} or {}
+    for shard in shards:
+        try:
+            taskqueue.add(url='/w/sitemap/build', params=dict(params, shard=shard), name='sitemap-%u-%u' % (shard, bucket), countdown=DELAY)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+def get_pages(shard):
+    """Returns the publicly readable pages of a shard, with only title and
+    updated loaded."""
+    pages = []
+    legacy = model.WikiContent.use_legacy_lookups()
+    for batch in model.fetch_batches(model.WikiContent.get_sitemap_query(shard), BATCH_SIZE):
+        if legacy:
+            batch = [p for p in batch if get_shard(p.title) == shard]
+        pages.extend(batch)
+        if len(pages) >= MAX_URLS:
+            logging.warning('Sitemap shard %u is full, increase sitemap.SHARDS.' % shard)
+            return pages[:MAX_URLS]
+    return pages
+
+
+def store(shard, xml, count, base):
+    """Saves the XML of a shard, gzipped."""
+    data = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=data, mode='wb')
+    f.write(xml.encode('utf-8'))
+    f.close()
+    model.WikiSitemap(key_name=model.WikiSitemap.key_name_for(shard), data=db.Blob(data.getvalue()), count=count, base=base).put()
+
+
+def get_shards():
+    """Returns the stored shards, None for the ones not built yet."""
+    return model.WikiSitemap.get_by_key_name([model.WikiSitemap.key_name_for(s) for s in range(SHARDS)])
@@ -21,3 +21,51 @@ $(document).ready(function(){
 		return false;
 	});
 });
+
+// Suggests page titles while typing a [[link]].
+$(document).ready(function(){
+	var editor = $("#editor");
+	var list = $("<ul id='completions'></ul>").hide().insertAfter(editor);
+	var last = null;
+
+	var get_prefix = function () {
+		var text = editor.val().substring(0, editor[0].selectionStart);
+		var match = /\[\[([^\[\]\|\n]*)$/.exec(text);
+		return match ? match[1] : null;
+	};
+
+	editor.keyup(function () {
+		var prefix = get_prefix();
+		if (prefix === null || prefix.length == 0) {
+			list.hide();
+			last = null;
+			return;
+		}
+		if (prefix == last)
+			return;
+		last = prefix;
+		$.getJSON("/w/complete", {q: prefix}, function (titles) {
+			if (prefix != last)
+				return;
+			list.empty();
+			$.each(titles, function (idx, title) {
+				$("<li></li>").text(title).appendTo(list);
+			});
+			list.toggle(titles.length > 0);
+		});
+	});
+
+	list.delegate("li", "click", function () {
+		var prefix = get_prefix();
+		if (prefix === null)
+			return;
+		var pos = editor[0].selectionStart;
+		var text = editor.val();
+		var title = $(this).text();
+		editor.val(text.substring(0, pos - prefix.length) + title + "]]" + text.substring(pos));
+		editor[0].selectionStart = editor[0].selectionEnd = pos - prefix.length + title.length + 2;
+		editor.focus();
+		list.hide();
+		last = null;
+	});
+});
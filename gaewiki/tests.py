@@ -1,13 +1,20 @@
 # encoding=utf-8
 
+import json
 import unittest
+import urlparse
 
+from google.appengine.api import memcache
 from google.appengine.api import users
+from google.appengine.ext import db
 from google.appengine.ext import testbed
 
 import access
+import cache
 import model
+import search
 import settings
+import sitemap
 import util
 
 try:
@@ -25,11 +32,25 @@ class TestCase(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
         settings.settings = None
+        cache.clear()
 
     def tearDown(self):
         self.testbed.deactivate()
 
+    def run_flush_tasks(self):
+        """Runs the queued dependent page flushes (see WikiContent.queue_flush)
+        to completion."""
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = stub.get_filtered_tasks(url='/w/cache/flush')
+        stub.FlushQueue('default')
+        for task in tasks:
+            data = json.loads(urlparse.parse_qs(task.payload)['data'][0])
+            state = (0, None)
+            while state is not None:
+                state = model.WikiContent.flush_dependents(data['titles'], data['labels'], exclude=data['exclude'], position=state[0], cursor=state[1])
+
     def test_page_packing(self):
         """Tests whether page haders can be built correctly."""
         header = util.pack_page_header({
@@ -55,6 +76,20 @@ class TestCase(unittest.TestCase):
         args = util.parse_page('key: value\nkeys: one, two\n#ignore: me\r---\rhello, world.')
         self.assertEquals(3, len(args))
 
+    def test_parsed_bodies_are_copies(self):
+        body = 'keys: one, two\n---\nhello'
+        args = util.parse_page(body)
+        args['keys'].append('three')
+        args['text'] = 'changed'
+        self.assertEquals(util.parse_page(body), {'keys': ['one', 'two'], 'text': 'hello'})
+
+        lru = cache.LRU(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+        self.assertEquals((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
     def test_page_url(self):
         """Makes sure we can build correct page URLs."""
         self.assertEquals('/foo', util.pageurl('foo'))
@@ -82,6 +117,11 @@ class TestCase(unittest.TestCase):
         for got, wanted in checks:
             self.assertEquals(util.wikify(got), wanted)
 
+    def test_wikify_existing_pages(self):
+        model.WikiContent(title='foo bar', body='# foo bar').put()
+        self.assertEquals(util.wikify('[[foo_bar]], [[baz]]'), '<a class="int" href="/foo_bar" title="foo_bar">foo_bar</a>, <a class="int missing" href="/w/edit?page=baz" title="baz (create)">baz</a>')
+        self.assertEquals(util.find_page_links('[[foo]], [[List:bar]], [[google:baz]], [[Image:x]]'), set(['foo']))
+
     def test_page_creation(self):
         self.assertEquals(len(model.WikiContent.get_all()), 0)
         model.WikiContent(title='foo').put()
@@ -125,6 +165,19 @@ class TestCase(unittest.TestCase):
         settings.change({'editors': 'one, two'})
         self.assertEquals(settings.get('editors'), ['one', 'two'])
 
+    def test_settings_caching(self):
+        self.assertTrue(settings.get_all() is settings.get_all())
+        version = settings.get_version()
+        settings.change({'foo': 'bar'})
+        self.assertNotEquals(settings.get_version(), version)
+        self.assertEquals(settings.get('foo'), 'bar')
+
+        # Another instance changed the settings.
+        settings.settings = {'foo': 'stale'}
+        memcache.incr(settings.VERSION_KEY)
+        cache.clear()
+        self.assertEquals(settings.get('foo'), 'bar')
+
     def test_uurlencode_filter(self):
         self.assertEquals(util.uurlencode(None), '')
         self.assertEquals(util.uurlencode('foo bar'), 'foo_bar')
@@ -139,6 +192,33 @@ class TestCase(unittest.TestCase):
     def test_markdown_extensions(self):
         self.assertEquals(util.parse_markdown('# foo'), '<h1>foo</h1>')
 
+    def test_markdown_engine_reuse(self):
+        md = util.get_markdown_engine([])
+        self.assertTrue(md is util.get_markdown_engine([]))
+        self.assertFalse(md is util.get_markdown_engine([], 'html4'))
+        self.assertEquals(util.parse_markdown('[foo][1]\n\n[1]: /foo'), '<p><a href="/foo">foo</a></p>')
+        self.assertEquals(util.parse_markdown('[foo][1]'), '<p>[foo][1]</p>')
+
+    def test_fragment_caching(self):
+        self.assertTrue('Hello' in util.render_fragment('gaewiki:sidebar', '# Hello'))
+        page = model.WikiContent(title='gaewiki:sidebar', body='# Sidebar')
+        page.put()
+        self.assertEquals(util.render_fragment('gaewiki:sidebar', '# Hello'), '<h1>Sidebar</h1>')
+        page.body = '# Changed'
+        page.put()
+        self.assertEquals(util.render_fragment('gaewiki:sidebar', '# Hello'), '<h1>Changed</h1>')
+
+    def test_fragment_flush_reaches_other_instances(self):
+        model.WikiContent(title='gaewiki:sidebar', body='[[foo]]').put()
+        self.assertTrue('missing' in util.render_fragment('gaewiki:sidebar', ''))
+        other_instance = util._fragments['gaewiki:sidebar']
+
+        model.WikiContent(title='foo', body='# foo').put()
+        self.run_flush_tasks()
+        util._fragments['gaewiki:sidebar'] = other_instance
+        cache.clear()
+        self.assertFalse('missing' in util.render_fragment('gaewiki:sidebar', ''))
+
     def test_display_title(self):
         body = 'display_title: foo\n---\n# bar'
         text = util.wikify_filter(body)
@@ -197,11 +277,32 @@ class TestCase(unittest.TestCase):
         self.assertEquals(access.can_edit_page('foo', is_admin=False), False)
 
     def test_list_changes_in_closed_wiki(self):
+        model.WikiContent(title='foo', body='# foo').put()
+        model.WikiContent(title='bar', body='public: yes\n---\n# bar').put()
+
         settings.change({"open-reading": "yes", "open-writing": "yes"})
-        self.assertTrue(isinstance(model.WikiContent.get_changes(), list))
+        pages, cursor = model.WikiContent.get_changes()
+        self.assertTrue(isinstance(pages, list))
+        self.assertTrue(set(['foo', 'bar']) <= set([p.title for p in pages]))
+        self.assertTrue(all([p.created is not None for p in pages]))
 
         settings.change({"open-reading": "no", "open-writing": "no"})
-        self.assertTrue(isinstance(model.WikiContent.get_changes(), list))
+        pages, cursor = model.WikiContent.get_changes()
+        self.assertTrue(isinstance(pages, list))
+        self.assertTrue('bar' in [p.title for p in pages])
+        self.assertFalse('foo' in [p.title for p in pages])
+
+    def test_changes_feed(self):
+        if not TEST_VIEWS:
+            return
+        self.testbed.setup_env(PATH_INFO='/w/changes.rss', HTTP_HOST='wiki.example.com', overwrite=True)
+        alice = model.WikiUser.get_or_create(users.User('alice@example.com'))
+        model.WikiContent(title='foo', body='display_title: Foo page\n---\n# foo', author=alice).put()
+        pages, cursor = model.WikiContent.get_changes()
+        xml = view.get_change_feed(pages)
+        self.assertTrue(u'<title>foo</title>' in xml)
+        self.assertTrue(u'<author>alice@example.com</author>' in xml)
+        self.assertTrue(u'<pubDate>' in xml)
 
     def test_edit_page_with_local_editors(self):
         pass
@@ -286,6 +387,25 @@ class TestCase(unittest.TestCase):
         self.assertTrue(nickname.startswith('alice'))
         self.assertTrue(nickname[-4:].isdigit())
 
+    def test_user_keys_and_nicknames(self):
+        alice = model.WikiUser.get_or_create(users.User('alice@example.com'))
+        self.assertEquals(alice.key().name(), 'email:alice@example.com')
+        self.assertEquals(model.WikiNickname.get_by_key_name('alice').owner, str(alice.key()))
+
+        cache.clear()
+        self.assertEquals(model.WikiUser.get_or_create(users.User('alice@example.com')).key(), alice.key())
+
+        bob = model.WikiUser.get_or_create(users.User('bob@example.com'))
+        bob.nickname = 'Alice'
+        self.assertRaises(model.NicknameTaken, bob.put)
+
+        alice.nickname = 'carol'
+        alice.put()
+        self.assertEquals(model.WikiNickname.get_by_key_name('alice'), None)
+        bob.nickname = 'alice'
+        bob.put()
+        self.assertEquals(model.WikiNickname.get_by_key_name('alice').owner, str(bob.key()))
+
     def test_underscores_in_titles(self):
         p1 = model.WikiContent(title='Hello World')
         p1.put()
@@ -293,6 +413,397 @@ class TestCase(unittest.TestCase):
         p2 = model.WikiContent.get_by_title('Hello_World')
         self.assertEquals(p1.key(), p2.key())
 
+    def test_title_keys(self):
+        page = model.WikiContent(title='Hello World')
+        page.put()
+        self.assertEquals(page.key(), model.WikiContent.key_for_title('Hello_World'))
+
+        page = model.WikiContent.get_by_title('Hello World')
+        page.body = 'name: Goodbye World\n---\n# Goodbye'
+        page.put()
+        self.assertFalse(model.WikiContent.get_by_title('Hello World').is_saved())
+        self.assertTrue(model.WikiContent.get_by_title('Goodbye World').is_saved())
+
+        pages = model.WikiContent.get_by_titles(['Goodbye_World', 'Hello World'])
+        self.assertEquals(pages.keys(), ['Goodbye World'])
+
+        # The renamed instance now stands for the moved entity.
+        self.assertEquals(page.key(), model.WikiContent.key_for_title('Goodbye World'))
+        page.body = 'name: Goodbye World\n---\n# Goodbye again'
+        page.put()
+        self.assertEquals(db.get(model.WikiContent.key_for_title('Hello World')), None)
+        page.delete()
+        self.assertEquals(db.get(model.WikiContent.key_for_title('Goodbye World')), None)
+
+    def test_legacy_page_rekeying(self):
+        settings.change({'title-keys': None})
+        model.WikiContent(key_name='legacy', title='foo', body='# foo').put()
+        self.assertEquals(model.WikiContent.get_by_title('foo').key().name(), 'legacy')
+        self.assertEquals(model.WikiContent.rekey_pages(model.WikiContent.all().fetch(100)), 1)
+        self.assertEquals(model.WikiContent.get_by_title('foo').key(), model.WikiContent.key_for_title('foo'))
+        self.assertEquals(len(model.WikiContent.get_all()), 2)
+
+    def test_legacy_listings_queue_rekey(self):
+        model._rekey_queued = False
+        settings.change({'title-keys': None})
+        db.Model.put(model.WikiContent(key_name='legacy', title='foo', body='labels: bar\n---\n# foo', labels=['bar']))
+
+        self.assertEquals([p.title for p in model.WikiContent.get_index_page()[0]], ['foo', 'gaewiki:settings'])
+        self.assertEquals([p.title for p in model.WikiContent.get_label_page('bar')[0]], ['foo'])
+        self.assertTrue('foo' in [p.title for p in sitemap.get_pages(sitemap.get_shard('foo'))])
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.assertEquals(len(stub.get_filtered_tasks(url='/w/data/rekey')), 1)
+
+    def test_request_cache(self):
+        page = model.WikiContent(title='foo', body='# foo')
+        page.put()
+        self.assertTrue(model.WikiContent.get_by_title('foo') is page)
+        self.assertTrue(model.WikiContent.get_by_titles(['foo'])['foo'] is page)
+
+        cache.clear()
+        page = model.WikiContent.get_by_title('foo')
+        self.assertTrue(model.WikiContent.get_by_title('foo') is page)
+        page.delete()
+        self.assertFalse(model.WikiContent.get_by_title('foo').is_saved())
+
+        user = users.User('alice@example.com')
+        self.assertTrue(model.WikiUser.get_or_create(user) is model.WikiUser.get_or_create(user))
+
+    def test_stale_html_does_not_overwrite_newer_saves(self):
+        model.WikiContent(title='foo', body='# old').put()
+        stale = model.WikiContent.get_by_key_name(model.WikiContent.key_name_for('foo'))
+        newer = model.WikiContent.get_by_key_name(model.WikiContent.key_name_for('foo'))
+        newer.body = '# new'
+        newer.put()
+
+        stale.html_version = None
+        stale.get_html()
+        self.assertEquals(model.WikiContent.get_by_key_name(model.WikiContent.key_name_for('foo')).body, '# new')
+
+    def test_stored_html(self):
+        page = model.WikiContent(title='foo', body='# foo\n\n[[foo]] [[bar]] [[List:baz]]')
+        page.put()
+        self.assertEquals(page.dependencies, ['label:baz', 'link:bar', 'link:foo'])
+        self.assertTrue('<a class="int" href="/foo"' in page.html)
+        self.assertTrue('missing' in page.html)
+        self.assertTrue(page.get_html() is page.html)
+
+        model.WikiContent(title='bar', body='labels: baz\n---\n# bar').put()
+        self.run_flush_tasks()
+        cache.clear()
+        page = model.WikiContent.get_by_title('foo')
+        self.assertEquals(page.html, None)
+        self.assertFalse('missing' in page.get_html())
+        self.assertTrue('labellist' in page.get_html())
+
+        page.body = '# changed'
+        self.assertEquals(page.get_html(), '<h1>changed</h1>')
+
+    def test_dependent_cache_purging(self):
+        model.WikiContent(title='foo', body='[[bar]]').put()
+        model.WikiContent(title='baz', body='[[List:qux]]').put()
+        namespace = cache.get_namespace()
+        memcache.set_multi({'Page:foo': 'old', 'Page:baz': 'old', 'Page:bar': 'old'}, namespace=namespace)
+
+        model.WikiContent(title='bar', body='# bar').put()
+        self.assertEquals(memcache.get('Page:foo', namespace=namespace), 'old')
+        self.run_flush_tasks()
+        self.assertEquals(memcache.get('Page:foo', namespace=namespace), None)
+        self.assertEquals(memcache.get('Page:bar', namespace=namespace), None)
+        self.assertEquals(memcache.get('Page:baz', namespace=namespace), 'old')
+
+        model.WikiContent(title='quux', body='labels: qux\n---\n# quux').put()
+        self.run_flush_tasks()
+        self.assertEquals(memcache.get('Page:baz', namespace=namespace), None)
+
+    def test_dependent_flush_batches(self):
+        for idx in range(5):
+            model.WikiContent(title='page %u' % idx, body='[[bar]]').put()
+        self.run_flush_tasks()
+        model.WikiContent(title='bar', body='# bar').put()
+
+        old_size, model.WikiContent.FLUSH_BATCH_SIZE = model.WikiContent.FLUSH_BATCH_SIZE, 2
+        try:
+            state, batches = (0, None), 0
+            while state is not None:
+                state = model.WikiContent.flush_dependents(['bar'], [], position=state[0], cursor=state[1])
+                batches += 1
+        finally:
+            model.WikiContent.FLUSH_BATCH_SIZE = old_size
+        self.assertTrue(batches > 2)
+        for idx in range(5):
+            self.assertEquals(model.WikiContent.get_by_title('page %u' % idx).html, None)
+
+    def test_cache_generations(self):
+        namespace = cache.get_namespace()
+        self.assertEquals(cache.get_namespace(), namespace)
+        cache.bump_generation()
+        self.assertNotEquals(cache.get_namespace(), namespace)
+
+    def test_batched_export_helpers(self):
+        alice = model.WikiUser.get_or_create(users.User('alice@example.com'))
+        for idx in range(5):
+            model.WikiContent(title='page %u' % idx, author=alice).put()
+        batches = list(model.fetch_batches(model.WikiContent.all(), 2))
+        self.assertEquals([len(b) for b in batches], [2, 2, 1])
+        self.assertEquals(model.get_authors(batches[0]).keys(), [alice.key()])
+
+    def test_prefetch_authors(self):
+        alice = model.WikiUser.get_or_create(users.User('alice@example.com'))
+        for idx in range(3):
+            model.WikiContent(title='page %u' % idx, author=alice).put()
+        pages = model.prefetch_authors(model.WikiContent.get_changes()[0])
+        self.assertEquals(len(pages), 3)
+        self.assertEquals(set([p.author.get_nickname() for p in pages]), set(['alice']))
+
+    def test_bulk_import(self):
+        model.WikiContent(title='foo', body='# old foo').put()
+        count = model.WikiContent.import_records([
+            {'title': 'foo', 'author': 'alice@example.com', 'body': '# new foo'},
+            {'title': 'bar_baz', 'author': None, 'body': '# bar baz\n\n[[foo]]'},
+        ])
+        self.assertEquals(count, 2)
+        cache.clear()
+        foo = model.WikiContent.get_by_title('foo')
+        self.assertEquals(foo.body, '# new foo')
+        self.assertEquals(foo.get_author_nick(), 'alice')
+        self.assertEquals(len(foo.get_history()), 1)
+        self.assertTrue(model.WikiContent.get_by_title('bar baz').is_saved())
+
+        count = model.WikiContent.import_records([{'title': 'foo', 'author': None, 'body': '# foo'}], merge=True)
+        self.assertEquals(count, 0)
+
+    def test_repeated_imports_change_nothing(self):
+        model.WikiContent(title='foo', body='# old foo').put()
+        records = [{'title': 'foo', 'author': None, 'body': '# new foo'}]
+        self.assertEquals(model.WikiContent.import_records(records), 1)
+        self.assertEquals(model.WikiContent.import_records(records), 0)
+        self.assertEquals(len(model.WikiContent.get_by_title('foo').get_history()), 1)
+
+        job = model.WikiImport(chunks=1)
+        job.put()
+        model.WikiImportChunk(parent=job, key_name=model.WikiImportChunk.key_name_for(0), records=json.dumps(records)).put()
+        db.run_in_transaction(model.WikiImport.finish_chunk, job.key(), 0, 1)
+        db.run_in_transaction(model.WikiImport.finish_chunk, job.key(), 0, 1)
+        job = model.WikiImport.get(job.key())
+        self.assertTrue(job.is_finished())
+        self.assertEquals(job.pages, 1)
+
+    def test_batch_links_render_as_existing(self):
+        model.WikiContent.put_many([
+            model.WikiContent(title='one', body='# one\n\n[[two]]'),
+            model.WikiContent(title='two', body='# two\n\n[[one]]'),
+        ])
+        cache.clear()
+        for title in ('one', 'two'):
+            self.assertFalse('missing' in model.WikiContent.get_by_title(title).get_html())
+
+    def test_revision_deltas(self):
+        page = model.WikiContent.get_by_title('foo')
+        bodies = []
+        for idx in range(25):
+            body = '# foo\n\n' + '\n'.join(['line %u' % n for n in range(50)]) + '\n\nedit %u' % idx
+            page.update(body, None, False)
+            bodies.append(body)
+
+        revisions = list(reversed(page.get_history()))
+        self.assertEquals(len(revisions), 24)
+        self.assertEquals([r.get_body() for r in revisions], bodies[:-1])
+        self.assertFalse(revisions[-1].is_delta())
+        self.assertTrue(revisions[0].is_delta())
+        self.assertTrue(revisions[19].is_keyframe())
+        self.assertFalse(revisions[19].is_delta())
+        self.assertEquals(model.WikiRevision.get_by_key(str(revisions[3].key())).get_body(), bodies[3])
+
+    def test_revision_bodies_along_chain(self):
+        for title in ('bar', 'foo'):
+            page = model.WikiContent.get_by_title(title)
+            for idx in range(25):
+                page.update('# %s\n\n' % title + '\n'.join(['line %u' % n for n in range(50)]) + '\n\nedit %u' % idx, None, False)
+
+        revisions = model.WikiRevision.all().order('title').order('-created').fetch(100)
+        self.assertEquals(len(revisions), 48)
+        self.assertEquals(model.WikiRevision.get_bodies(revisions), [r.get_body() for r in revisions])
+        self.assertEquals(model.WikiRevision.get_bodies(revisions[30:]), [r.get_body() for r in revisions[30:]])
+
+    def test_history_pages(self):
+        page = model.WikiContent.get_by_title('foo')
+        for idx in range(4):
+            page.update('# foo\n\nedit %u' % idx, users.User('alice@example.com'), False)
+
+        revisions, cursor = page.get_history_page(limit=2)
+        self.assertEquals(len(revisions), 2)
+        self.assertNotEquals(cursor, None)
+        authors = model.get_authors(revisions)
+        self.assertEquals([u.get_nickname() for u in authors.values()], ['alice'])
+
+        older, cursor = page.get_history_page(cursor, limit=2)
+        self.assertEquals(len(older), 1)
+        self.assertEquals(cursor, None)
+        self.assertTrue(older[0].created < revisions[-1].created)
+
+    def test_diff(self):
+        rows = util.diff_texts(u'# foo\n\nsome old text\nkept <b>', u'# foo\n\nsome new text\nkept <b>\nadded')
+        self.assertEquals(rows, [
+            ('same', u'# foo'),
+            ('same', u''),
+            ('del', u'some <del>old</del> text'),
+            ('ins', u'some <ins>new</ins> text'),
+            ('same', u'kept &lt;b&gt;'),
+            ('ins', u'added'),
+        ])
+        self.assertEquals(util.diff_texts(u'foo', u'foo'), [])
+
+    def test_search(self):
+        self.assertEquals(search.tokenize(u'The Cats\' stories, a bus'), [u'cat', u'story', u'bus'])
+        model.WikiContent(title='Cats', body='# Cats\n\nCats eat fish.').put()
+        model.WikiContent(title='Dogs', body='# Dogs\n\nDogs chase cats.').put()
+        model.WikiContent(title='Secret', body='private: yes\n---\n# Secret\n\nThe cat is hidden.').put()
+        search.update_index(['Cats', 'Dogs', 'Secret'])
+
+        results = search.search(u'cat')
+        self.assertEquals([p.title for p, s in results], ['Cats', 'Dogs'])
+        self.assertEquals(results[1][1], u'# Dogs\n\nDogs chase <b>cats</b>.')
+        self.assertEquals(len(search.search(u'cat', is_admin=True)), 3)
+        self.assertEquals(search.search(u'fish dogs')[0][0].title, 'Dogs')
+
+        model.WikiContent.get_by_title('Dogs').delete()
+        search.update_index(['Dogs'])
+        self.assertEquals([p.title for p, s in search.search(u'cat')], ['Cats'])
+
+        self.assertEquals(search.complete(u'c'), [u'Cats'])
+        self.assertEquals(search.complete(u''), [u'Cats', u'Secret'])
+
+        stored = dict([(e.key().name(), json.loads(e.postings)) for e in model.WikiSearchShard.all() if e.postings])
+        built = search.build_index([(p.title, p.body) for p in model.WikiContent.all()])
+        self.assertEquals(stored, dict([(e.key().name(), json.loads(e.postings)) for e in built if e.postings]))
+
+    def test_title_completion(self):
+        for title in [u'Foo bar', u'foo', u'Food', u'Bar']:
+            model.WikiContent(title=title, body=u'# %s' % title).put()
+        search.update_index([u'Foo bar', u'foo', u'Food', u'Bar'])
+        self.assertEquals(search.complete(u'FOO'), [u'foo', u'Foo bar', u'Food'])
+        self.assertEquals(search.complete(u'foo_b'), [u'Foo bar'])
+        self.assertEquals(search.complete(u'foo', limit=1), [u'foo'])
+        self.assertEquals(search.complete(u'x'), [])
+
+        model.WikiContent.get_by_title(u'Food').delete()
+        search.update_index([u'Food'])
+        self.assertEquals(search.complete(u'foo'), [u'foo', u'Foo bar'])
+
+    def test_paginated_listings(self):
+        for title in ['b', 'A', 'Label:x', 'c']:
+            model.WikiContent(title=title, body='labels: x\n---\n# %s' % title).put()
+
+        pages, cursor = model.WikiContent.get_index_page(limit=3)
+        self.assertEquals([p.title for p in pages], ['A', 'b', 'c'])
+        pages, cursor = model.WikiContent.get_index_page(cursor, limit=3)
+        self.assertEquals([p.title for p in pages], ['Label:x'])
+        self.assertEquals(cursor, None)
+
+        pages, cursor = model.WikiContent.get_label_page('x', limit=2)
+        self.assertEquals([p.title for p in pages], ['A', 'b'])
+        self.assertFalse(u'class="more"' in util.list_pages_by_label('x'))
+
+        pages, cursor = model.WikiContent.get_changes(limit=10)
+        self.assertEquals(len(pages), 4)
+
+    def test_label_index(self):
+        model.WikiContent(title='a', body='labels: x\n---\n# a').put()
+        self.assertEquals(util.list_pages_by_label('x').count('<li>'), 1)
+
+        page = model.WikiContent(title='b', body='labels: x\ndisplay_title: Bee\n---\n# b')
+        page.put()
+        index = model.WikiLabelIndex.get_by_key_name(model.WikiContent.key_name_for('x'))
+        self.assertEquals([(e[0], e[1]) for e in index.get_entries()], [('a', None), ('b', 'Bee')])
+        self.assertTrue(u'>Bee</a>' in util.list_pages_by_label('x'))
+
+        page.body = '# b'
+        page.put()
+        self.assertEquals([e[0] for e in model.WikiContent.get_label_entries('x')], ['a'])
+
+        model.WikiContent.get_by_title('a').delete()
+        self.assertEquals(util.list_pages_by_label('x'), '')
+
+    def test_label_index_build_keeps_concurrent_saves(self):
+        model.WikiContent(title='a', body='labels: x\n---\n# a').put()
+        key_name = model.WikiContent.key_name_for('x')
+        db.run_in_transaction(model.WikiLabelIndex._start_build, key_name)
+        model.WikiLabelIndex.update({'x': (set(['z']), [['z', None, None, '']])})
+        index = model.WikiLabelIndex.get_by_label('x')
+        self.assertFalse(index.building)
+        self.assertEquals([e[0] for e in index.get_entries()], ['a', 'z'])
+
+        model.WikiLabelIndex.drop_all()
+        self.assertEquals([e[0] for e in model.WikiLabelIndex.get_by_label('x').get_entries()], ['a'])
+
+    def test_sitemap_shards(self):
+        model.WikiContent(title='foo', body='# foo').put()
+        model.WikiContent(title='bar', body='public: yes\n---\n# bar').put()
+        shard = sitemap.get_shard('foo')
+        self.assertEquals(model.WikiContent.get_by_title('foo').sitemap_shard, shard)
+        self.assertEquals([p.title for p in sitemap.get_pages(shard)], ['foo'])
+
+        settings.change({'open-reading': 'no'})
+        self.assertEquals(sitemap.get_pages(shard), [])
+        self.assertEquals([p.title for p in sitemap.get_pages(sitemap.get_shard('bar'))], ['bar'])
+
+        sitemap.store(shard, u'<urlset/>', 1, 'http://wiki.example.com')
+        self.assertEquals(sitemap.get_shards()[shard].count, 1)
+        self.assertEquals(sitemap.get_shards()[shard].base, 'http://wiki.example.com')
+
+        if TEST_VIEWS:
+            self.testbed.setup_env(PATH_INFO='/w/sitemap/build', HTTP_HOST='app.appspot.com', overwrite=True)
+            xml = view.get_sitemap(sitemap.get_pages(sitemap.get_shard('bar')), 'http://wiki.example.com')
+            self.assertTrue(u'<loc>http://wiki.example.com/bar</loc>' in xml)
+
+    def test_change_stamps(self):
+        counter, changed_at = cache.get_change_stamp()
+        self.assertEquals(changed_at, None)
+        model.WikiContent(title='foo', body='# foo').put()
+        cache.clear()
+        new_counter, changed_at = cache.get_change_stamp()
+        self.assertNotEquals(new_counter, counter)
+        self.assertNotEquals(changed_at, None)
+
+    def test_access_policy(self):
+        settings.change({'open-reading': 'yes', 'readers': None, 'editors': None, 'page-blacklist': '^Secret'})
+        policy = access.get_policy()
+        self.assertTrue(access.get_policy() is policy)
+        self.assertTrue(access.is_page_blacklisted('Secret page'))
+
+        alice, bob = users.User('alice@example.com'), users.User('bob@example.com')
+        model.WikiContent(title='Open', body='# Open').put()
+        model.WikiContent(title='Closed', body='private: yes\neditors: %s\n---\n# Closed' % alice.email()).put()
+        closed = model.WikiContent.get_by_title('Closed')
+        self.assertEquals(closed.get_acl(), (True, False, [alice.email()]))
+
+        pages = model.WikiContent.get_by_titles(['Open', 'Closed'])
+        pages = [pages['Open'], pages['Closed']]
+        self.assertEquals([p.title for p in access.filter_readable(pages, alice, False)], ['Open', 'Closed'])
+        self.assertEquals([p.title for p in access.filter_readable(pages, bob, False)], ['Open'])
+        self.assertEquals([p.title for p in access.filter_readable(pages, bob, True)], ['Open', 'Closed'])
+
+        settings.change({'readers': bob.email()})
+        self.assertFalse(access.get_policy() is policy)
+        self.assertEquals(len(access.filter_readable(pages, bob, False)), 2)
+
+    def test_gzipped_memcache(self):
+        text = u'Привет, ' * 10
+        cache.set_gzipped('foo', cache.gzip_text(text), version=1)
+        self.assertEquals(cache.gunzip_text(cache.get_gzipped('foo', version=1)), text)
+        self.assertEquals(cache.get_gzipped('foo', version=2), None)
+
+        old_size, cache.CHUNK_SIZE = cache.CHUNK_SIZE, 10
+        try:
+            data = cache.gzip_text(text)
+            cache.set_gzipped('bar', data)
+            self.assertEquals(cache.get_gzipped('bar'), data)
+            memcache.delete('bar#2')
+            self.assertEquals(cache.get_gzipped('bar'), None)
+        finally:
+            cache.CHUNK_SIZE = old_size
+
     def test_page_redirect(self):
         """Makes sure that redirects are supported when displaying pages."""
         if not TEST_VIEWS:
@@ -1,11 +1,17 @@
 # encoding=utf-8
 
 import cgi
+import difflib
+import json
 import logging
 import os
 import re
+import threading
 import urllib
 
+from google.appengine.api import memcache
+
+import cache
 import markdown
 import model
 import settings
@@ -22,6 +28,16 @@ def parse_page(page_content):
     return model.WikiContent.parse_body(page_content)
 
 
+def as_list(value):
+    """Returns a property value as a list: header properties whose names end
+    with "s" are lists, settings changed from code may be single strings."""
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
 def pageurl(title):
     return '/' + pageurl_rel(title)
 
@@ -34,7 +50,16 @@ def pageurl_rel(title):
     return urllib.quote(title.replace(' ', '_'))
 
 
-def wikify_filter(text, display_title=None, page_name=None):
+# Bump when rendering changes, so that stored page HTML is rendered again.
+RENDERER_VERSION = 1
+
+
+def get_renderer_version():
+    """Returns the stamp that stored page HTML must have to be served."""
+    return '%u/%s' % (RENDERER_VERSION, settings.get_fingerprint())
+
+
+def wikify_filter(text, display_title=None, page_name=None, assume_saved=False):
     props = parse_page(text)
     text = parse_markdown(props['text'])
 
@@ -49,25 +74,88 @@ def wikify_filter(text, display_title=None, page_name=None):
         if not display_title.strip():
             new = ''
         text = re.sub('<h1>(.+)</h1>', new, text)
-    return wikify(text, title=page_name)
+    return wikify(text, title=page_name, assume_saved=assume_saved)
+
+
+# Markdown instances are expensive to build and not thread safe, so every
+# thread keeps its own, one per extension list and output format.
+_markdown_engines = threading.local()
+
+
+def get_markdown_engine(extensions, output_format=markdown.DEFAULT_OUTPUT_FORMAT):
+    """Returns a reset Markdown instance configured with the extensions."""
+    engines = getattr(_markdown_engines, 'cache', None)
+    if engines is None:
+        engines = _markdown_engines.cache = {}
+    key = (tuple(extensions), output_format)
+    md = engines.get(key)
+    if md is None:
+        md = markdown.Markdown(extensions=markdown.load_extensions(extensions), output_format=output_format)
+        engines[key] = md
+    else:
+        md.reset()
+    return md
 
 
 def parse_markdown(text):
-    return markdown.markdown(text, settings.get('markdown-extensions', [])).strip()
+    md = get_markdown_engine(settings.get('markdown-extensions', []))
+    return md.convert(text).strip()
 
 
 WIKI_WORD_PATTERN = re.compile("\[\[(.+?)\]\]")
 
 
-def wikify(text, title=None):
-    text, count = WIKI_WORD_PATTERN.subn(lambda x: wikify_one(x, title), text)
+def wikify(text, title=None, assume_saved=False):
+    """Renders wiki links.  With assume_saved, links to the page itself are
+    rendered as existing, which is needed when rendering a page that is
+    being saved."""
+    existing = model.WikiContent.find_existing_titles(find_page_links(text))
+    if assume_saved and title:
+        existing.add(title.replace('_', ' '))
+    text, count = WIKI_WORD_PATTERN.subn(lambda x: wikify_one(x, title, existing), text)
     text = re.sub(r'\.  ', '.&nbsp; ', text)
     text = re.sub(u' +(—|--) +', u'&nbsp;— ', text)
     return text
 
 
-def wikify_one(pat, real_page_title):
-    """Wikifies one link."""
+def find_page_links(text):
+    """Returns names of local pages that the text links to, skipping
+    interwiki links and special tokens."""
+    names = set()
+    for link in WIKI_WORD_PATTERN.findall(text):
+        page_name = link.split("|", 1)[0]
+        if ':' in page_name:
+            prefix = page_name.split(':', 1)[0]
+            if ' ' not in prefix:
+                if prefix in ('List', 'gaewiki', 'ListChildren', 'Image'):
+                    continue
+                if settings.get(u'interwiki-' + prefix):
+                    continue
+        names.add(page_name)
+    return names
+
+
+def extract_dependencies(text, title):
+    """Returns the things that rendering text depends on: linked pages
+    (link:title), listed labels (label:name) and images (image:key)."""
+    deps = set(['link:' + name.replace('_', ' ') for name in find_page_links(text)])
+    for link in WIKI_WORD_PATTERN.findall(text):
+        page_name = link.split("|", 1)[0]
+        if ':' not in page_name:
+            continue
+        prefix, arg = page_name.split(':', 1)
+        if prefix == 'List':
+            deps.add('label:' + arg.split(';')[0])
+        elif prefix == 'ListChildren':
+            deps.add('label:' + ('gaewiki:parent:' + (arg or title or '')).split(';')[0])
+        elif prefix == 'Image':
+            deps.add('image:' + arg.split(';')[0])
+    return sorted(deps)
+
+
+def wikify_one(pat, real_page_title, existing=None):
+    """Wikifies one link.  If a set of existing page titles is given, it is
+    used instead of looking the page up."""
     page_name = page_title = pat.group(1)
     if "|" in page_name:
         page_name, page_title = page_name.split("|", 1)
@@ -90,14 +178,18 @@ def wikify_one(pat, real_page_title):
             if iwlink:
                 return '<a class="iw iw-%s" href="%s" target="_blank">%s</a>' % (parts[0], iwlink.replace('%s', urllib.quote(parts[1].encode('utf-8'))), page_title)
 
-    page = model.WikiContent.get_by_title(page_name)
+    if existing is not None:
+        is_saved = page_name.replace('_', ' ') in existing
+    else:
+        page = model.WikiContent.get_by_title(page_name)
+        is_saved = page is not None and page.is_saved()
 
     page_class = "int"
     page_link = pageurl(page_name)
     page_hint = page_name
     page_text = page_title
 
-    if page is None or not page.is_saved():
+    if not is_saved:
         page_class += " missing"
         page_hint += " (create)"
         page_link = "/w/edit?page=" + pageurl_rel(page_name)
@@ -153,23 +245,57 @@ def render_image(args, title):
     return "<a href='%s' title='%s'><img %s/></a>" % (target, title, attrs)
 
 
+# Rendered sidebar and footer HTML by page title, as (stamp, html) tuples.
+_fragments = {}
+
+# Bumped when a fragment is flushed, so that all instances notice.
+FRAGMENTS_KEY = 'gaewiki:fragments'
+
+
+def render_fragment(page_name, default_body):
+    """Returns the rendered HTML of a page shown on every page (sidebar,
+    footer).  The HTML is kept in instance memory and memcache and rendered
+    again when the page, a page it depends on or settings change."""
+    page = model.WikiContent.get_by_title(page_name)
+    namespace = cache.get_namespace()
+    flushed = cache.get_counter(FRAGMENTS_KEY)
+    if page.is_saved():
+        stamp = '%s/%s/%s/%s' % (page.updated.isoformat(), settings.get_version(), namespace, flushed)
+    else:
+        stamp = 'default/%s/%s/%s' % (settings.get_version(), namespace, flushed)
+
+    cached = _fragments.get(page_name)
+    if cached is None or cached[0] != stamp:
+        cached = memcache.get('Fragment:' + page_name, namespace=namespace)
+        if cached is None or cached[0] != stamp:
+            body = page.body if page.is_saved() else default_body
+            cached = (stamp, wikify_filter(body))
+            memcache.set('Fragment:' + page_name, cached, namespace=namespace)
+        _fragments[page_name] = cached
+    return cached[1]
+
+
+def flush_fragment(title):
+    """Drops the rendered HTML of the sidebar or footer page when it, or a
+    page it depends on, is changed."""
+    if title in (settings.get('sidebar', 'gaewiki:sidebar'), settings.get('footer', 'gaewiki:footer')):
+        _fragments.pop(title, None)
+        memcache.delete('Fragment:' + title, namespace=cache.get_namespace())
+        cache.bump_counter(FRAGMENTS_KEY)
+
+
 def list_pages_by_label(label):
     """Returns a formatted list of pages with the specified label."""
     keys = label.split(';')
-    pages = model.WikiContent.get_by_label(keys[0])
-
-    if 'sort=date,desc' in keys:
-        pages.sort(key=lambda p: p.created, reverse=True)
-    else:
-        pages.sort(key=lambda p: p.title.lower())
+    entries = model.WikiContent.get_label_entries(keys[0], newest_first='sort=date,desc' in keys)
 
     items = []
-    for page in pages:
-        page_name = page.redirect or page.title
+    for title, display_title, redirect, created in entries:
+        page_name = redirect or title
         items.append(u'<li><a class="int" href="%(url)s" title="%(hint)s">%(title)s</a></li>' % {
             "url": pageurl(page_name),
             "hint": cgi.escape(page_name),
-            "title": page.get_property('display_title', page.title),
+            "title": title if display_title is None else display_title,
         })
 
     if not items:
@@ -289,3 +415,85 @@ def extract_links(text):
             links.append(link)
 
     return links
+
+
+def make_delta(base, text):
+    """Returns a JSON encoded list of operations that turns base into text:
+    [start, end] pairs copy lines of base, strings are inserted as is."""
+    base_lines = base.splitlines(True)
+    text_lines = text.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, text_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j1 != j2:
+            ops.append(''.join(text_lines[j1:j2]))
+    return json.dumps(ops, separators=(',', ':'))
+
+
+def apply_delta(base, delta):
+    """Reverses make_delta(): returns the text the delta was made for."""
+    base_lines = base.splitlines(True)
+    parts = []
+    for op in json.loads(delta):
+        if isinstance(op, list):
+            parts.extend(base_lines[op[0]:op[1]])
+        else:
+            parts.append(op)
+    return u''.join(parts)
+
+
+WORD_SPLIT_PATTERN = re.compile(r'(\s+)')
+
+
+def diff_texts(old, new, context=3):
+    """Compares texts line by line, changed lines are compared word by word.
+    Returns a list of (kind, html) rows, kind being 'same', 'del', 'ins' or
+    'skip' (unchanged lines left out, context lines are kept around
+    changes)."""
+    if old == new:
+        return []
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    rows = []
+    end = 0
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for group in matcher.get_grouped_opcodes(context):
+        if group[0][1] > end:
+            rows.append(('skip', u'…'))
+        end = group[-1][2]
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                rows.extend([('same', cgi.escape(line)) for line in old_lines[i1:i2]])
+                continue
+            deleted = [cgi.escape(line) for line in old_lines[i1:i2]]
+            inserted = [cgi.escape(line) for line in new_lines[j1:j2]]
+            for idx in range(min(len(deleted), len(inserted))):
+                deleted[idx], inserted[idx] = diff_words(old_lines[i1 + idx], new_lines[j1 + idx])
+            rows.extend([('del', line) for line in deleted])
+            rows.extend([('ins', line) for line in inserted])
+    if end < len(old_lines):
+        rows.append(('skip', u'…'))
+    return rows
+
+
+def diff_words(old, new):
+    """Compares two lines word by word, returns both as HTML with the
+    differences marked with <del> and <ins>."""
+    old_words = WORD_SPLIT_PATTERN.split(old)
+    new_words = WORD_SPLIT_PATTERN.split(new)
+    old_html = []
+    new_html = []
+    matcher = difflib.SequenceMatcher(None, old_words, new_words, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            text = cgi.escape(u''.join(old_words[i1:i2]))
+            old_html.append(text)
+            new_html.append(text)
+            continue
+        if i1 != i2:
+            old_html.append(u'<del>%s</del>' % cgi.escape(u''.join(old_words[i1:i2])))
+        if j1 != j2:
+            new_html.append(u'<ins>%s</ins>' % cgi.escape(u''.join(new_words[j1:j2])))
+    return u''.join(old_html), u''.join(new_html)
@@ -59,23 +59,17 @@ def render(template_name, data):
 
 
 def get_sidebar():
+    """Returns the rendered sidebar HTML."""
     page_name = settings.get('sidebar', 'gaewiki:sidebar')
-    page = model.WikiContent.get_by_title(page_name)
-    if page.is_saved():
-        body = page.body
-    else:
-        body = u'<a href="/"><img src="/gae-wiki-static/logo-186.png" width="186" alt="logo" height="167"/></a>\n\nThis is a good place for a brief introduction to your wiki, a logo and such things.\n\n[Edit this text](/w/edit?page=%s)' % page_name
-    return body
+    body = u'<a href="/"><img src="/gae-wiki-static/logo-186.png" width="186" alt="logo" height="167"/></a>\n\nThis is a good place for a brief introduction to your wiki, a logo and such things.\n\n[Edit this text](/w/edit?page=%s)' % page_name
+    return util.render_fragment(page_name, body)
 
 
 def get_footer():
+    """Returns the rendered footer HTML."""
     page_name = settings.get('footer', 'gaewiki:footer')
-    page = model.WikiContent.get_by_title(page_name)
-    if page.is_saved():
-        body = page.body
-    else:
-        body = u'This wiki is built with [GAEWiki](http://gaewiki.googlecode.com/).'
-    return body
+    body = u'This wiki is built with [GAEWiki](http://gaewiki.googlecode.com/).'
+    return util.render_fragment(page_name, body)
 
 
 def view_page(page, user=None, is_admin=False, revision=None):
@@ -115,43 +109,77 @@ def edit_page(page):
     })
 
 
-def list_pages(pages):
+def list_pages(pages, first_url=None, next_url=None, label=None):
     logging.debug(u'Listing %u pages.' % len(pages))
     return render('index.html', {
         'pages': pages,
+        'first_url': first_url,
+        'next_url': next_url,
+        'label': label,
+    })
+
+
+def show_search_results(query, results):
+    return render('search.html', {
+        'query': query,
+        'results': results,
     })
 
 
-def list_pages_feed(pages):
+def list_pages_feed(pages, next_url=None):
     logging.debug(u'Listing %u pages.' % len(pages))
     return render('index.rss', {
-        'pages': pages,
+        'pages': model.prefetch_authors(pages),
+        'next_url': next_url,
     })
 
 
-def show_page_history(page, user=None, is_admin=False):
+def show_page_history(page, user=None, is_admin=False, cursor=None):
+    revisions, next_cursor = page.get_history_page(cursor)
     return render('history.html', {
         'page_title': page.title,
-        'revisions': page.get_history(),
+        'revisions': model.prefetch_authors(revisions),
+        'cursor': cursor,
+        'next_cursor': next_cursor,
         'can_edit': access.can_edit_page(page.title, user, is_admin),
     })
 
 
-def get_sitemap(pages):
+def show_diff(page, old, new, rows):
+    return render('diff.html', {
+        'page_title': page.title,
+        'old': old,
+        'new': new,
+        'page': page,
+        'rows': rows,
+    })
+
+
+def get_sitemap(pages, base):
     return render('sitemap.xml', {
         'pages': pages,
+        'base': base,
+    })
+
+
+def get_sitemap_index(shards):
+    return render('sitemap-index.xml', {
+        'shards': shards,
     })
 
 
-def get_change_list(pages):
+def get_change_list(pages, first_url=None, next_url=None):
     return render('changes.html', {
-        'pages': pages,
+        'pages': model.prefetch_authors(pages),
+        'first_url': first_url,
+        'next_url': next_url,
     })
 
 
-def get_change_feed(pages):
+def get_change_feed(pages, next_url=None):
     return render('changes.rss', {
-        'pages': pages,
+        'pages': model.prefetch_authors(pages),
+        'next_url': next_url,
     })
 
 
@@ -168,8 +196,10 @@ def get_users(users):
     })
 
 
-def get_import_form():
-    return render('import.html', {})
+def get_import_form(job=None):
+    return render('import.html', {
+        'job': job,
+    })
 
 
 def show_interwikis(iw):